@@ -4,6 +4,8 @@ import datetime
 from math import exp
 from collections import Counter
 import os
+import calendar
+from functools import lru_cache, partial
 from operator import itemgetter
 
 def isfloat(val):
@@ -30,6 +32,131 @@ def time_convert(data,dt_column,dt_format,tz_offset):
         i.append(int(time.mktime(datetime.datetime.strptime(i[dt_column],dt_format).timetuple()))-tz_offset)
     return data
 
+TIME_FIELD_WIDTHS = {'Y': 4, 'm': 2, 'd': 2, 'H': 2, 'M': 2, 'S': 2}
+
+@lru_cache(maxsize=None)
+def compile_time_format(dt_format):
+    '''
+    Works out the fixed-width layout of a strptime format built from %Y, %m, %d, %H, %M, %S and single-character
+    separators, optionally ending in a separator and %f.
+    Returns (fields, separators, prefix length, fraction separator), or None if the format is not fixed-width.
+    The prefix is the seconds-resolution part of the timestamp, which is all that affects the UNIX time.
+    '''
+    fields = []
+    separators = []
+    pos = 0
+    i = 0
+    while i < len(dt_format):
+        if dt_format[i] == '%':
+            code = dt_format[i+1:i+2]
+            if code == 'f' and i+2 == len(dt_format) and separators and separators[-1][0] == pos-1:
+                return tuple(fields), tuple(separators[:-1]), pos-1, separators[-1][1]
+            if code not in TIME_FIELD_WIDTHS:
+                return None
+            fields.append((code, pos, pos+TIME_FIELD_WIDTHS[code]))
+            pos += TIME_FIELD_WIDTHS[code]
+            i += 2
+        else:
+            separators.append((pos, dt_format[i]))
+            pos += 1
+            i += 1
+    return tuple(fields), tuple(separators), pos, None
+
+@lru_cache(maxsize=65536)
+def prefix_to_unix(prefix,dt_format,host_local=False):
+    '''
+    Converts the seconds-resolution prefix of a fixed-width timestamp to a UNIX timestamp, read as UTC unless
+    host_local is set. Returns None if the prefix doesn't fit the format's fixed-width layout.
+    Cached, since the same second repeats across many rows.
+    '''
+    fields, separators, prefix_len, _ = compile_time_format(dt_format)
+    if len(prefix) != prefix_len or any(prefix[p] != c for p, c in separators) \
+            or not all(prefix[a:b].isdigit() for _, a, b in fields):
+        return None
+
+    values = {'Y': 1900, 'm': 1, 'd': 1, 'H': 0, 'M': 0, 'S': 0}  # strptime's defaults
+    for code, start, stop in fields:
+        values[code] = int(prefix[start:stop])
+    dt = datetime.datetime(values['Y'], values['m'], values['d'], values['H'], values['M'], values['S'])
+    if host_local:
+        return int(time.mktime(dt.timetuple()))
+    return calendar.timegm(dt.timetuple())
+
+def to_unix(value,dt_format,host_local=False):
+    '''
+    Converts a single datetime string to a UNIX timestamp, read as UTC unless host_local is set. Fixed-width
+    formats are sliced directly and cached by their seconds-resolution prefix; anything else, including values
+    that don't fit the fixed-width layout, falls back to strptime.
+    '''
+    layout = compile_time_format(dt_format)
+    if layout is not None:
+        prefix_len, frac_sep = layout[2], layout[3]
+        if frac_sep is None:
+            fits = len(value) == prefix_len
+        else:
+            frac = value[prefix_len+1:]
+            fits = value[prefix_len:prefix_len+1] == frac_sep and 0 < len(frac) <= 6 and frac.isdigit()
+        if fits:
+            result = prefix_to_unix(value[:prefix_len], dt_format, host_local)
+            if result is not None:
+                return result
+
+    tt = datetime.datetime.strptime(value, dt_format).timetuple()
+    if host_local:
+        return int(time.mktime(tt))
+    return calendar.timegm(tt)
+
+def fast_time_convert(data,dt_column,dt_format,tz_offset,host_local=False):
+    '''
+    Faster equivalent of time_convert, using to_unix.
+    data: an array containing the datetimes to be converted.
+    dt_column: the index position of the column containing the datetimes.
+    dt_format: the expected format of the input datetimes
+    tz_offset: seconds to subtract from the converted timestamp
+    host_local: read datetimes in the host's local time zone, as time_convert does. By default they are read as
+    UTC, so the result depends only on tz_offset and not on the machine the script runs on.
+    '''
+    for i in data[1:]:
+        i.append(to_unix(i[dt_column], dt_format, host_local)-tz_offset)
+    return data
+
+def time_column(values,dt_format,tz_offset,host_local=False):
+    '''
+    Converts a whole column of datetime strings to an int64 array of UNIX timestamps at once. For fixed-width
+    formats, values are grouped by their seconds-resolution prefix and each distinct prefix is converted once;
+    the fractional seconds are checked for length and digits here, not parsed. Values that don't fit the layout
+    are converted one at a time by to_unix, so they are accepted or rejected exactly as to_unix would.
+    values: a sequence of datetime strings
+    dt_format, tz_offset, host_local: as for fast_time_convert
+    '''
+    import numpy as np
+
+    values = np.asarray(values, dtype=str)
+    layout = compile_time_format(dt_format)
+    if layout is None or len(values) == 0:
+        return np.array([to_unix(x, dt_format, host_local) for x in values.tolist()], dtype=np.int64) - tz_offset
+
+    prefix_len, frac_sep = layout[2], layout[3]
+    lengths = np.char.str_len(values)
+    if frac_sep is None:
+        fits = lengths == prefix_len
+    else:
+        fits = (lengths > prefix_len+1) & (lengths <= prefix_len+7) & \
+               np.char.startswith(values, frac_sep, start=prefix_len)
+        # every character of the fraction must be a digit; shorter values are padded with NUL
+        frac = values.view(np.uint32).reshape(len(values), -1)[:, prefix_len+1:]
+        fits &= (((frac >= ord('0')) & (frac <= ord('9'))) | (frac == 0)).all(axis=1)
+
+    distinct, inverse = np.unique(values.astype(f"U{prefix_len}"), return_inverse=True)
+    converted = [prefix_to_unix(x, dt_format, host_local) for x in distinct.tolist()]
+    fits &= np.array([x is not None for x in converted])[inverse.reshape(-1)]
+    converted = np.array([0 if x is None else x for x in converted], dtype=np.int64)
+
+    output = converted[inverse.reshape(-1)]
+    for n in np.flatnonzero(~fits).tolist():
+        output[n] = to_unix(values[n], dt_format, host_local)
+    return output - tz_offset
+
 def parse_empty_predictions(data):
     '''
     Sometimes, the affect prediction code spins up before the student starts recording data.
@@ -114,13 +241,171 @@ def get_affect_prediction(data):
     print(Counter([x[-1] for x in data[1:]]))
     return data
 
-def link_qrf_intcode(qrf_location,transcript_data):
+def float_column(data,column):
+    '''
+    Parses a single column into a float array in one pass.
+    data: an array of rows, without a header
+    column: the index position of the column to parse
+    Returns the parsed values and a mask of which cells could be parsed; unparseable cells are NaN.
+    '''
+    import numpy as np
+
+    cells = [x[column] for x in data]
+    try:
+        values = np.array(cells, dtype=np.float64)
+        return values, np.ones(len(cells), dtype=bool)
+    except ValueError:
+        values = [np.nan] * len(cells)
+        parsed = np.ones(len(cells), dtype=bool)
+        for n, v in enumerate(cells):
+            try:
+                values[n] = float(v)
+            except ValueError:
+                parsed[n] = False
+        return np.array(values, dtype=np.float64), parsed
+
+def preprocess_affect(data,logit_columns,step_columns,label_columns=range(10,16),verbose=True):
+    '''
+    Array-based equivalent of parse_empty_predictions, logit_to_prob, trim_step_regression and
+    get_affect_prediction, run in that order. Each prediction column is parsed into a float array once, and the
+    empty-prediction filter, clipping, labeling and summaries all run as array operations.
+    data: an array containing the affect data, with a header row
+    logit_columns: a list of column indices containing logits to be converted to probabilities
+    step_columns: a list of column indices containing stepwise regression predictions to be trimmed to [0,1]
+    label_columns: the column indices to choose the predicted affective label from
+    verbose: print the same progress messages and summaries as the row-by-row functions
+
+    The output is the same as the row-by-row functions, value for value: the sigmoid uses math.exp, cells that
+    cannot be parsed are set to 0, NaN stays NaN, and a logit of infinity converts to NaN.
+    '''
+    import numpy as np
+
+    header = data[0]
+    rows = data[1:]
+    columns = sorted(set(logit_columns) | set(step_columns) | {10, 11, 12, 13, 15} | set(label_columns))
+    parsed = dict((j, float_column(rows, j)) for j in columns)
+
+    empty = np.ones(len(rows), dtype=bool)
+    for j, v in zip([10, 11, 12, 13, 15], [-0.168, 0.283, 0.013, 0.157, 0.446]):
+        empty &= parsed[j][0] == v
+    keep = np.flatnonzero(~empty)
+    if verbose:
+        print(f"Affective records after parsing empty predictions: {len(keep)+1}.")
+
+    # values[j] is (the column's numbers, which cells isfloat accepts, which cells are written as ints)
+    values = {}
+    for j in columns:
+        x, ok = parsed[j][0][keep], parsed[j][1][keep]
+        values[j] = (np.where(ok, x, 0), ok, np.zeros(len(keep), dtype=bool))
+
+    if verbose:
+        print("Converting logit values to probabilities...")
+    for j in logit_columns:
+        x, ok, _ = values[j]
+        # math.exp rather than np.exp, which can differ in the last bit; math.exp overflows just above 709.78,
+        # and those logits give inf/inf = NaN, as a logit of infinity does
+        big = x > 709
+        e = np.fromiter(map(exp, np.where(big, 0, x).tolist()), dtype=np.float64, count=len(x))
+        for n in np.flatnonzero(big).tolist():
+            try:
+                e[n] = exp(x[n])
+            except OverflowError:
+                e[n] = np.inf
+        with np.errstate(invalid='ignore'):
+            prob = e/(e+1)
+        values[j] = (np.where(ok, prob, 0), np.ones(len(x), dtype=bool), ~ok)
+
+    if verbose:
+        print("Thresholding stepwise regression values...")
+    for j in step_columns:
+        x, ok, _ = values[j]
+        below, above = ~ok | (x < 0), ok & (x > 1)
+        values[j] = (np.where(below, 0, np.where(above, 1, x)), np.ones(len(x), dtype=bool), below | above)
+
+    converted = sorted(set(logit_columns) | set(step_columns))
+    cells = []
+    for j in converted:
+        x, _, ints = values[j]
+        c = x.astype(object)
+        c[ints] = x[ints].astype(int)
+        cells.append(c.tolist())
+        if verbose:
+            # the builtins, so NaN affects the summary the same way it does in the row-by-row functions
+            print(f"Minimum value for column index {j}: {min(cells[-1]) if len(x) else None}")
+            print(f"Maximum value for column index {j}: {max(cells[-1]) if len(x) else None}")
+
+    label_columns = list(label_columns)
+    if verbose:
+        print("Recalculating predicted affective label...")
+    # the first highest score, skipping NaN unless it comes first, as max() and list.index() do
+    scores = np.column_stack([values[j][0] for j in label_columns])
+    best = scores[:, 0]
+    for k in range(1, len(label_columns)):
+        best = np.where(scores[:, k] > best, scores[:, k], best)
+    labels = [header[label_columns[n]] for n in np.argmax(scores == best[:, None], axis=1)] if len(keep) else []
+
+    output = [header]
+    first, last = converted[0], converted[-1]+1
+    contiguous = converted == list(range(first, last))
+    for r, vals, label in zip(keep.tolist(), zip(*cells), labels):
+        row = rows[r]
+        if contiguous:
+            row[first:last] = vals
+        else:
+            for j, v in zip(converted, vals):
+                row[j] = v
+        row.append(label)
+        output.append(row)
+
+    if verbose:
+        print("Counts of affective predictions...")
+        print(Counter(labels))
+    return output
+
+def read_qrf_log(path):
+    '''
+    Parses a single QRF log file into a dict of (observation timestamp, observation number): row.
+    Only the first row for each key is kept, matching the order the log file was written in.
+    '''
+    index = {}
+    with open(path,'r') as openfile:
+        for k in csv.reader(openfile):
+            if len(k) > 7:
+                index.setdefault((k[2], k[7].split(':')[-1]), k)
+    return index
+
+def build_qrf_index(qrf_location,prefixes,n_threads=8):
+    '''
+    Indexes QRF observations for transcript linking, parsing each relevant log file exactly once.
+    qrf_location: the path where qrf log files are located
+    prefixes: the filename prefixes that transcripts will be looked up by
+    n_threads: the number of threads used to read log files
+    Returns a dict of (filename prefix, observation timestamp, observation number): matching rows, with one row
+    per log file whose name contains the prefix, in directory listing order.
+    '''
+    from concurrent.futures import ThreadPoolExecutor
+
+    qrf_logs = os.listdir(qrf_location)
+    wanted = [j for j in qrf_logs if any(x in j for x in prefixes)]
+
+    with ThreadPoolExecutor(n_threads) as pool:
+        parsed = dict(zip(wanted, pool.map(read_qrf_log, [os.path.join(qrf_location, j) for j in wanted])))
+
+    index = {}
+    for x in prefixes:
+        for j in wanted:
+            if x in j:
+                for key, k in parsed[j].items():
+                    index.setdefault((x,) + key, []).append(k)
+    return index
+
+def link_qrf_intcode(qrf_location,transcript_data,n_threads=8):
     '''
     Links transcription codes to relevant QRF observations.
     qrf_location: the path where qrf log files are located
     transcript_data: an array containing codes for transcribed interviews
+    n_threads: the number of threads used to read QRF log files
     '''
-    qrf_logs = os.listdir(qrf_location)
     qrf_dt_format = "%Y.%m.%d.%H.%M.%S.%f"
     matches = 0  # tracking successful links
     transcript_data = [x for x in transcript_data if x[0] != '']  # removing empty rows at the end of the file
@@ -129,7 +414,7 @@ def link_qrf_intcode(qrf_location,transcript_data):
     output[0].extend(transcript_data[0][1:])
     output[0].extend(['Observation Assigned (UNIX)', 'Observation Started (UNIX)'])
 
-    print("Linking transcript codes to relevant QRF observations...")
+    parsed = []
     for i in transcript_data[1:]:
         bits = i[0].split('2019')
         filename = bits[0]
@@ -137,54 +422,569 @@ def link_qrf_intcode(qrf_location,transcript_data):
         temp_junk = bits[2].split('_')
         ts_start = '2019' + temp_junk[0].replace('audioindex','')
         obs_num = temp_junk[-1].replace('.3gp','')
+        parsed.append((i, filename, ts_obs, ts_start, obs_num))
+
+    print("Indexing QRF logs...")
+    qrf_index = build_qrf_index(qrf_location, set(x[1] for x in parsed), n_threads)
 
-        for j in qrf_logs:
-            if filename in j:
-                with open(qrf_input+"\\"+j,'r') as openfile:
-                    qrf_read = list(csv.reader(openfile))
-                for k in qrf_read:
-                    if k[2] == ts_obs and k[7].split(':')[-1] == obs_num:
-                        matches += 1  # double duty as unique identifier
-                        student_id, emotion, behavior, type = k[9].split(':')[-1], \
-                                                              k[11].split(':')[-1], \
-                                                              k[12].split(':')[-1], \
-                                                              k[13].split(':')[-1]
-
-                        match = [filename, ts_obs, ts_start, obs_num, matches, student_id, emotion, behavior, type]
-                        match.extend(i[1:])
-                        output.append(match)
-                        break  # we found our match, we can exit the loop
-
-    output = time_convert(output,1,qrf_dt_format,0)
-    output = time_convert(output,2,qrf_dt_format,0)
+    print("Linking transcript codes to relevant QRF observations...")
+    for i, filename, ts_obs, ts_start, obs_num in parsed:
+        for k in qrf_index.get((filename, ts_obs, obs_num), []):
+            matches += 1  # double duty as unique identifier
+            student_id, emotion, behavior, type = k[9].split(':')[-1], \
+                                                  k[11].split(':')[-1], \
+                                                  k[12].split(':')[-1], \
+                                                  k[13].split(':')[-1]
+
+            match = [filename, ts_obs, ts_start, obs_num, matches, student_id, emotion, behavior, type]
+            match.extend(i[1:])
+            output.append(match)
+
+    output = fast_time_convert(output,1,qrf_dt_format,0,host_local=True)
+    output = fast_time_convert(output,2,qrf_dt_format,0,host_local=True)
     print(f"Matched {matches} observations of a possible {len(transcript_data)-1}.")
     return output
 
 
-def synchronization_main(log_data,qrf_data,affect_data,output_name):
+TEST_IDS = ['test1', 'test2', 'test3', 'test6']  # student IDs used for testing, dropped before syncing
+
+def group_by_student(data,column):
+    '''
+    Groups rows by student ID in a single pass over the data.
+    data: an array of rows, without a header
+    column: the index position of the column containing the student ID
+    Returns a dict of student ID: rows, with each student's rows in their original order.
+    '''
+    groups = {}
+    for i in data:
+        groups.setdefault(i[column],[]).append(i)
+    return groups
+
+def synchronize_student(sid,log_subset,aff_subset,qrf_subset):
+    '''
+    Merges a single student's log, affect and QRF rows by timestamp, walking one cursor per source.
+    sid: the student ID
+    log_subset: the student's log rows, as read from the log file
+    aff_subset: the student's cleaned affect rows
+    qrf_subset: the student's linked QRF rows; if empty, log rows are passed through unsynchronized
+    Returns the synchronized output rows, and the QRF and affect rows that were matched to a log action.
+    '''
+    output = []
+    qrf_s = []
+    aff_s = []
+
+    log_subset = [[""] + x + [""] * 46 for x in log_subset]
+
+    if not qrf_subset:
+        return log_subset, qrf_s, aff_s
+
+    log_subset.sort(key=itemgetter(7))
+    aff_subset = sorted(aff_subset, key=itemgetter(0))
+    qrf_subset = sorted(qrf_subset, key=itemgetter(-2))
+
+    aff_i = 0
+    tscr_i = 0
+
+    for n, i in enumerate(log_subset):
+        i[7] = int(i[7])
+
+        if n == len(log_subset)-1:
+            break
+
+        next_ts = int(log_subset[n+1][7])
+
+        while int(i[7]) > int(qrf_subset[tscr_i][-1])*1000 + (3600*1000) and tscr_i < len(qrf_subset)-1:
+            tscr_i += 1
+
+        if aff_subset:
+            while int(i[7]) > int(aff_subset[aff_i][9]) and aff_i < len(aff_subset)-1:
+                aff_i += 1
+
+            while int(aff_subset[aff_i][9]) - int(i[7]) > 20000 and int(aff_subset[aff_i][9]) < next_ts:
+                if aff_i == len(aff_subset)-1:
+                    break  # the last prediction stays with this cursor
+
+                dummy_logs = ['Unpaired Affective Prediction',i[1]]
+                dummy_logs.extend(['']*63)
+                dummy_logs.extend(aff_subset[aff_i])
+                output.append(dummy_logs)
+                aff_i += 1
+
+        if int(i[7]) <= int(qrf_subset[tscr_i][-2])*1000 + 3600*1000 <= next_ts:
+            i[82:] = qrf_subset[tscr_i]
+            i[0] = "Observation Assigned"
+
+        if int(i[7]) <= int(qrf_subset[tscr_i][-1])*1000 + 3600*1000 <= next_ts:
+            i[82:] = qrf_subset[tscr_i]
+            i[0] = "Observation Started"
+            qrf_s.append(qrf_subset[tscr_i])
+
+        if aff_subset and 0 <= int(aff_subset[aff_i][9]) - int(i[7]) <= 20000:
+            i[65:82] = aff_subset[aff_i]
+            aff_s.append(aff_subset[aff_i])
+
+        output.append(i)
+
+    return output, qrf_s, aff_s
+
+class SyncWindow(object):
+    '''
+    Declares how events from one data source line up with log actions, for synchronize_student_windowed.
+    time_column: the index position of the event timestamp in the source's rows
+    lo, hi: the window around a log action, in log time units (ms). An event matches an action at time t if
+    t + lo <= event time <= t + hi; hi=None means up to and including the time of the next log action.
+    scale: multiplies event timestamps into log time units, e.g. 1000 for timestamps in seconds
+    offset: added to event timestamps after scaling
+    policy: which of the events in an action's window it is matched to. 'first_after' takes the earliest,
+    'nearest' the closest to the action, and 'all' matches every one of them.
+    '''
+    policies = ('first_after', 'nearest', 'all')
+
+    def __init__(self,time_column,lo,hi=None,scale=1,offset=0,policy='first_after'):
+        if policy not in self.policies:
+            raise ValueError(f"Unknown matching policy {policy}; expected one of {self.policies}.")
+        self.time_column = time_column
+        self.lo = lo
+        self.hi = hi
+        self.scale = scale
+        self.offset = offset
+        self.policy = policy
+
+    def event_times(self,data):
+        '''
+        Returns the aligned times of a source's rows as an int64 array.
+        '''
+        import numpy as np
+
+        return np.array([int(x[self.time_column]) for x in data], dtype=np.int64)*self.scale + self.offset
+
+    def match(self,action_times,event_times):
+        '''
+        Matches sorted log action times to event times, using a binary search per action over the sorted events.
+        Returns a list with the matched event indices for each action.
+        '''
+        import numpy as np
+
+        order = np.argsort(event_times, kind='stable')
+        events = event_times[order]
+        lo = np.searchsorted(events, action_times + self.lo, side='left')
+        if self.hi is None:
+            upper = np.append(action_times[1:], np.iinfo(np.int64).max)
+        else:
+            upper = action_times + self.hi
+        hi = np.searchsorted(events, upper, side='right')
+
+        nearest = np.searchsorted(events, action_times)  # first event at or after each action
+
+        matches = []
+        for k in range(len(action_times)):
+            a, b = lo[k], hi[k]
+            if a >= b:
+                matches.append([])
+            elif self.policy == 'all':
+                matches.append(order[a:b].tolist())
+            elif self.policy == 'nearest':
+                j = min(max(nearest[k], a), b-1)
+                if j > a and abs(events[j-1] - action_times[k]) <= abs(events[j] - action_times[k]):
+                    j -= 1
+                matches.append([int(order[j])])
+            else:
+                matches.append([int(order[a])])
+        return matches
+
+DEFAULT_WINDOWS = {
+    'affect': SyncWindow(9, 0, 20000),
+    'qrf_assigned': SyncWindow(-2, 0, None, scale=1000, offset=3600*1000),
+    'qrf_started': SyncWindow(-1, 0, None, scale=1000, offset=3600*1000),
+}
+# the windows synchronize_student hard-codes: affect predictions up to 20 s after an action, and QRF
+# observations (in seconds, an hour behind the logs) between an action and the next one
+
+def synchronize_student_windowed(sid,log_subset,aff_subset,qrf_subset,windows=DEFAULT_WINDOWS):
+    '''
+    Merges a single student's log, affect and QRF rows by timestamp, using configurable windows.
+    Takes the same arguments and returns the same values as synchronize_student, plus:
+    windows: a dict of SyncWindow for 'affect', 'qrf_assigned' and 'qrf_started' events
+
+    Unlike synchronize_student, events don't need to be sorted or non-overlapping, every log action is written,
+    and affect is synchronized for students with no QRF data too. Affect predictions that match no action are
+    written as 'Unpaired Affective Prediction' rows after the last action before them. If an action matches several
+    events under the 'all' policy, the action is written once per event.
+    '''
+    import numpy as np
+
+    output = []
+    qrf_s = []
+    aff_s = []
+
+    log_subset = [[""] + x + [""] * 46 for x in log_subset]
+    for i in log_subset:
+        i[7] = int(i[7])
+    log_subset.sort(key=itemgetter(7))
+    action_times = np.array([i[7] for i in log_subset], dtype=np.int64)
+
+    empty = [[] for _ in log_subset]
+    aff_times = windows['affect'].event_times(aff_subset)
+    aff_match = windows['affect'].match(action_times, aff_times) if aff_subset else empty
+    if qrf_subset:
+        assigned = windows['qrf_assigned'].match(action_times, windows['qrf_assigned'].event_times(qrf_subset))
+        started = windows['qrf_started'].match(action_times, windows['qrf_started'].event_times(qrf_subset))
+    else:
+        assigned = started = empty
+
+    unpaired = set(range(len(aff_subset))) - set(j for x in aff_match for j in x)
+    unpaired = sorted(unpaired, key=lambda j: aff_times[j])
+    after = np.searchsorted(action_times, aff_times[unpaired], side='right') if unpaired else []
+    u = 0
+
+    def write_unpaired(upto):
+        nonlocal u
+        while u < len(unpaired) and after[u] <= upto:
+            dummy_logs = ['Unpaired Affective Prediction', sid]
+            dummy_logs.extend(['']*63)
+            dummy_logs.extend(aff_subset[unpaired[u]])
+            output.append(dummy_logs)
+            u += 1
+
+    write_unpaired(0)
+    for n, i in enumerate(log_subset):
+        base = i[:]
+        for k in range(max(1, len(aff_match[n]), len(assigned[n]), len(started[n]))):
+            row = base[:] if k else i
+            if k < len(assigned[n]):
+                row[82:] = qrf_subset[assigned[n][k]]
+                row[0] = "Observation Assigned"
+            if k < len(started[n]):
+                row[82:] = qrf_subset[started[n][k]]
+                row[0] = "Observation Started"
+                qrf_s.append(qrf_subset[started[n][k]])
+            if k < len(aff_match[n]):
+                row[65:82] = aff_subset[aff_match[n][k]]
+                aff_s.append(aff_subset[aff_match[n][k]])
+            output.append(row)
+        write_unpaired(n+1)
+
+    return output, qrf_s, aff_s
+
+def peak_rss():
+    '''
+    Returns the peak resident set size of this process in bytes. On Linux this is the kernel's high-water mark,
+    which reset_peak_rss() sets back to the current size; elsewhere it is the peak for the life of the process.
+    Returns None where it can't be measured: on Windows this needs psutil.
+    '''
+    import sys
+
+    try:
+        with open('/proc/self/status', 'r') as f:
+            for line in f:
+                if line.startswith('VmHWM:'):
+                    return int(line.split()[1])*1024
+    except OSError:
+        pass
+    try:
+        import resource
+    except ImportError:
+        try:
+            import psutil
+            return psutil.Process().memory_info().peak_wset
+        except (ImportError, AttributeError):
+            return None
+    rss = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+    return rss if sys.platform == 'darwin' else rss*1024  # kilobytes everywhere but macOS
+
+def current_rss():
+    '''
+    Returns the current resident set size of this process in bytes, or None where it can't be measured: outside
+    Linux this needs psutil.
+    '''
+    try:
+        with open('/proc/self/statm', 'r') as f:
+            return int(f.read().split()[1])*os.sysconf('SC_PAGE_SIZE')
+    except (OSError, ValueError, AttributeError):
+        pass
+    try:
+        import psutil
+        return psutil.Process().memory_info().rss
+    except ImportError:
+        return None
+
+def reset_peak_rss():
+    '''
+    Resets the kernel's high-water mark for this process's resident set size to its current size, so peak_rss()
+    measures from here on. Only possible on Linux; returns False where it isn't.
+    '''
+    try:
+        with open('/proc/self/clear_refs', 'w') as f:
+            f.write('5')
+        return True
+    except OSError:
+        return False
+
+class PeakRSS(object):
+    '''
+    Measures the peak resident set size of this process while a block of code runs:
+        with PeakRSS() as peak:
+            ...
+        peak.bytes
+    On Linux the kernel's high-water mark is reset when the block starts and read when it ends. Elsewhere the
+    current RSS is sampled on a background thread every interval seconds, which can miss spikes shorter than the
+    interval. bytes is None where neither is possible.
+
+    Blocks can be nested, as a student's merge is inside the merge stage. Resetting the mark for an inner block
+    would lose the peak of the blocks around it so far, so it is folded into every open block first.
+    '''
+    _open = []  # blocks measured by resetting the high-water mark, outermost first
+
+    def __init__(self,interval=0.01):
+        self.interval = interval
+        self.bytes = None
+        self._thread = None
+
+    def __enter__(self):
+        import threading
+
+        self._fold()
+        if reset_peak_rss():
+            PeakRSS._open.append(self)
+            return self
+        self.bytes = current_rss()
+        if self.bytes is not None:
+            self._stop = threading.Event()
+            self._thread = threading.Thread(target=self._sample, daemon=True)
+            self._thread.start()
+        return self
+
+    def _sample(self):
+        while not self._stop.wait(self.interval):
+            self.bytes = max(self.bytes, current_rss())
+
+    def __exit__(self,*exc):
+        if self in PeakRSS._open:
+            self._fold()
+            PeakRSS._open.remove(self)
+        elif self._thread is not None:
+            self._stop.set()
+            self._thread.join()
+            self.bytes = max(self.bytes, current_rss())
+        return False
+
+    @staticmethod
+    def _fold():
+        if PeakRSS._open:
+            peak = peak_rss()
+            for x in PeakRSS._open:
+                x.bytes = peak if x.bytes is None else max(x.bytes, peak)
+
+class SyncReport(object):
+    '''
+    Collects metrics for a sync run and writes them out as a JSON run report.
+
+    stage(name) is a context manager that records, for the code run inside it, the wall time, the CPU time of
+    this process and of any worker processes that finished during it, rows in and out, the peak RSS of this
+    process during the stage (see PeakRSS), and the largest peak RSS of any student merged in a worker process
+    during it. Set rows_in and rows_out on the dict it yields.
+
+    Each student merged by synchronization_main or stream_synchronization is recorded in students, with its wall
+    and CPU time, rows in and out, and the peak RSS during its merge and process ID of the process that merged it.
+
+    profile: True to run every stage under cProfile, or a collection of stage names to profile only those.
+    Profiles are written to profile_dir as <stage>.prof, for reading with pstats or snakeviz.
+    '''
+    def __init__(self,profile=False,profile_dir="."):
+        self.profile = profile
+        self.profile_dir = profile_dir
+        self.started = time.strftime("%Y-%m-%d %H:%M:%S")
+        self.tic = time.perf_counter()
+        self.stages = []
+        self.students = []
+
+    def stage(self,name,rows_in=None):
+        from contextlib import contextmanager
+
+        @contextmanager
+        def timed():
+            rec = {"stage": name, "rows_in": rows_in, "rows_out": None}
+            profiler = None
+            if self.profile is True or (self.profile and name in self.profile):
+                import cProfile
+                profiler = cProfile.Profile()
+            children = os.times()
+            nstudents = len(self.students)
+            tic, cpu = time.perf_counter(), time.process_time()
+            peak = PeakRSS()
+            try:
+                with peak:
+                    if profiler:
+                        profiler.enable()
+                    try:
+                        yield rec
+                    finally:
+                        if profiler:
+                            profiler.disable()
+            finally:
+                if profiler:
+                    os.makedirs(self.profile_dir, exist_ok=True)
+                    rec["profile"] = os.path.join(self.profile_dir, f"{name}.prof")
+                    profiler.dump_stats(rec["profile"])
+                now = os.times()
+                rec["wall_s"] = time.perf_counter() - tic
+                rec["cpu_s"] = time.process_time() - cpu
+                rec["worker_cpu_s"] = (now.children_user - children.children_user) + \
+                                      (now.children_system - children.children_system)
+                rec["peak_rss"] = peak.bytes
+                rec["worker_peak_rss"] = max((x["peak_rss"] for x in self.students[nstudents:]
+                                              if x["pid"] != os.getpid() and x["peak_rss"] is not None), default=None)
+                self.stages.append(rec)
+                print(f"{name}: {rec['wall_s']:.2f}s wall, {rec['cpu_s']:.2f}s CPU.")
+        return timed()
+
+    def write(self,path):
+        '''
+        Writes the run report to path as JSON, with per-stage and per-student metrics and totals.
+        '''
+        import json
+        import platform
+
+        walls = sorted(x["wall_s"] for x in self.students)
+        report = {
+            "started": self.started,
+            "finished": time.strftime("%Y-%m-%d %H:%M:%S"),
+            "host": platform.node(),
+            "python": platform.python_version(),
+            "stages": self.stages,
+            "students": self.students,
+            "totals": {
+                "wall_s": time.perf_counter() - self.tic,
+                "students": len(self.students),
+                "student_wall_s": sum(walls),
+                "student_wall_s_median": walls[len(walls)//2] if walls else None,
+                "student_wall_s_max": walls[-1] if walls else None,
+            },
+        }
+        with open(path, 'w') as f:
+            json.dump(report, f, indent=1)
+
+def stage(report,name,rows_in=None):
+    '''
+    report.stage(name, rows_in) if there is a report, otherwise a context that records nothing.
+    '''
+    from contextlib import nullcontext
+
+    if report is None:
+        return nullcontext({})
+    return report.stage(name, rows_in)
+
+def timed_merge(merge,sid,log_subset,aff_subset,qrf_subset):
+    '''
+    Runs merge for one student, returning its output followed by the student's metrics for SyncReport.students.
+    The peak RSS is that of the process the student was merged in, during the merge.
+    '''
+    with PeakRSS() as peak:
+        tic, cpu = time.perf_counter(), time.process_time()
+        rows, qrf_s, aff_s = merge(sid, log_subset, aff_subset, qrf_subset)
+    return rows, qrf_s, aff_s, {"student": sid,
+                                "wall_s": time.perf_counter() - tic,
+                                "cpu_s": time.process_time() - cpu,
+                                "rows_in": len(log_subset) + len(aff_subset) + len(qrf_subset),
+                                "rows_out": len(rows),
+                                "peak_rss": peak.bytes,
+                                "pid": os.getpid()}
+
+def count_synched(merge,sid,log_subset,aff_subset,qrf_subset):
+    '''
+    Runs merge for one student, returning its output with the number of distinct QRF and affect rows it synched in
+    place of the rows themselves, followed by anything else merge returns. Workers send back these counts rather
+    than the matched rows; since every QRF and affect row belongs to one student, they add up to the totals.
+    '''
+    res = merge(sid, log_subset, aff_subset, qrf_subset)
+    return (res[0], len(set(tuple(x) for x in res[1])), len(set(tuple(x) for x in res[2]))) + tuple(res[3:])
+
+def group_students(log_data,qrf_data,affect_data):
+    '''
+    Drops test IDs from the log and affect data and groups each source by student ID once, returning the log,
+    affect and QRF groups.
+    '''
+    log_groups = group_by_student([x for x in log_data[1:] if x[0] not in TEST_IDS],0)
+    aff_groups = group_by_student([x for x in affect_data[1:] if x[0] not in TEST_IDS],1)
+    qrf_groups = group_by_student(qrf_data[1:],5)
+    return log_groups, aff_groups, qrf_groups
+
+def distinct_rows(groups):
+    '''
+    Counts the distinct rows across a dict of groups. Every row belongs to one student, so this adds up per group.
+    '''
+    return sum(len(set(tuple(x) for x in rows)) for rows in groups.values())
+
+def merge_students(students,n_workers=None,windows=None,report=None):
+    '''
+    Merges students one at a time, yielding (student ID, output rows, distinct QRF rows synched, distinct affect
+    rows synched) for each, in the order given. Every sync mode merges students through this function.
+    students: an iterable of (student ID, log rows, affect rows, QRF rows); it is read lazily unless n_workers
+    is set, so a stream of students is only read as fast as they are merged
+    n_workers: if greater than 1, the number of processes to merge students across
+    windows: a dict of SyncWindow to merge students with synchronize_student_windowed; by default students are
+    merged with the fixed windows in synchronize_student
+    report: a SyncReport to record every student's merge in
+    '''
+    from itertools import starmap
+
+    merge = synchronize_student
+    if windows is not None:
+        merge = partial(synchronize_student_windowed, windows=windows)
+    if report is not None:
+        merge = partial(timed_merge, merge)
+    merge = partial(count_synched, merge)
+
+    pool = None
+    if n_workers and n_workers > 1:
+        students = list(students)
+    if n_workers and n_workers > 1 and len(students) > 1:
+        from concurrent.futures import ProcessPoolExecutor
+
+        pool = ProcessPoolExecutor(n_workers)
+        merged = zip([x[0] for x in students],
+                     pool.map(merge, *zip(*students), chunksize=max(1, len(students)//(n_workers*4))))
+    else:
+        merged = ((x[0], merge(*x)) for x in students)
+
+    try:
+        for sid, res in merged:  # results come back in the order given
+            if report is not None:
+                report.students.append(res[3])
+            yield (sid,) + tuple(res[:3])
+    finally:
+        if pool:
+            pool.shutdown()
+
+def synchronization_main(log_data,qrf_data,affect_data,output_name,n_workers=None,windows=None,report=None):
     '''
     Takes multiple data sources and synchronizes based on timestamp alignment.
     log_data: an array containing student log data from Betty's Brain
     qrf_data: an array containing linked qrf and transcript code data
     affect_data: an array containing student affect data
+    n_workers: if greater than 1, the number of processes to merge students across
+    windows: a dict of SyncWindow to merge students with synchronize_student_windowed; by default students are
+    merged with the fixed windows in synchronize_student
+    report: a SyncReport to record the group, merge and check stages and every student's merge in
+
+    Each source is grouped by student ID once, and each student is then merged by synchronize_student,
+    so the total work is linear in the number of rows rather than students x rows. Students are written in
+    sorted order of student ID, whether or not they are merged in parallel.
     '''
     print("Preparing to synchronize files...")
-    linked = 0
-    qrf_s = []
-    aff_s = []
+    qrf_synched = 0
+    aff_synched = {}
 
     writer = csv.writer(open(output_name, 'w', newline=""))
     writer.writerow(['Special Event Marker'] + log_data[0] + affect_data[0] + qrf_data[0])
 
-    log_data = [x for x in log_data if x[0] not in ['test1', 'test2', 'test3', 'test6']]  # removing test IDs
-    affect_data = [x for x in affect_data if x[0] not in ['test1', 'test2', 'test3', 'test6']]  # removing test IDs
-
-    unique_log = set([x[0] for x in log_data[1:]])
-    unique_qrf = set([x[5] for x in qrf_data[1:]])
-    unique_affect = set([x[1] for x in affect_data[1:]])
-
-    log_data = [[""] + x + [""] * 46 for x in log_data]
+    with stage(report, "group", len(log_data) + len(affect_data) + len(qrf_data) - 3) as rec:
+        log_groups, aff_groups, qrf_groups = group_students(log_data, qrf_data, affect_data)
+        rec["rows_out"] = sum(len(x) for groups in (log_groups, aff_groups, qrf_groups) for x in groups.values())
 
+    unique_log = set(log_groups)
+    unique_affect = set(aff_groups)
+    unique_qrf = set(qrf_groups)
     print(f"Found {len(unique_log)} student IDs in log data.")
     print(f"Found {len(unique_affect)} student IDs in affect data.")
     print(f"Found {len(unique_qrf)} student IDs in transcript and QRF data.")
@@ -192,82 +992,408 @@ def synchronization_main(log_data,qrf_data,affect_data,output_name):
     print(f"The following student IDs are present in log data, but not in affect data: {unique_log-unique_affect}.")
     print(f"The following student IDs are present in log data, but not in transcripts: {unique_log-unique_qrf}.")
 
-    for sid in list(unique_log):
-        if sid not in unique_qrf:
-            sid_subset = [x for x in log_data[1:] if x[1] == sid]
-            writer.writerows(sid_subset)
+    sids = sorted(unique_log)
+    students = [(sid, log_groups[sid], aff_groups.get(sid, []), qrf_groups.get(sid, [])) for sid in sids]
+
+    with stage(report, "merge", sum(len(x) for s in students for x in s[1:])) as rec:
+        nrows = 0
+        for sid, rows, sid_qrf, sid_aff in merge_students(students, n_workers, windows, report):
+            writer.writerows(rows)
+            qrf_synched += sid_qrf
+            aff_synched[sid] = sid_aff
+            nrows += len(rows)
+        rec["rows_out"] = nrows
+
+    with stage(report, "check", len(qrf_data) + len(affect_data) - 2):
+        qrf_total = len(set(tuple(x) for x in qrf_data[1:]))
+        print(f"QRF log observations that have not been synched: {qrf_total - qrf_synched}.")
+        print(f"Total QRF log observations: {qrf_total}.")
+
+        aff_total = distinct_rows(aff_groups)
+        print(len(set(tuple(x) for x in aff_groups.get("A50", []))) - aff_synched.get("A50", 0))
+        print(f"Affective observations that have not been synched: {aff_total - sum(aff_synched.values())}.")
+        print(f"Total affective observations: {aff_total}.")
+
+def student_fingerprint(log_subset,aff_subset,qrf_subset):
+    '''
+    Identifies one student's inputs by [row count, max timestamp, content hash] for each of the log, affect and
+    QRF sources. Only the hash decides whether a student has changed; the counts and timestamps are kept in the
+    manifest to show what changed.
+    '''
+    import hashlib
+
+    def fingerprint(rows,column):
+        times = []
+        for x in rows:
+            try:
+                times.append(int(x[column]))
+            except (ValueError, IndexError):
+                pass
+        return [len(rows), max(times) if times else None, hashlib.sha1(repr(rows).encode('utf-8')).hexdigest()]
+
+    # log timestamps are column 6 of the raw rows; synchronize_student pads a marker column in front of them
+    return {"log": fingerprint(log_subset, 6), "affect": fingerprint(aff_subset, 9),
+            "qrf": fingerprint(qrf_subset, -1)}
+
+def incremental_synchronization(log_data,qrf_data,affect_data,output_name,segment_dir,n_workers=None,windows=None,
+                                report=None):
+    '''
+    Incremental equivalent of synchronization_main, for re-running a sync after new data arrives.
+    segment_dir: a directory holding one output segment per student, and a manifest of the fingerprint of each
+    student's inputs (see student_fingerprint) when their segment was merged
+    The other arguments are as for synchronization_main.
+
+    Only students whose log, affect or QRF rows have changed since the last run, or who have no segment yet, are
+    merged again. The output is then assembled by concatenating every student's segment in sorted order of
+    student ID, and is the same as synchronization_main would write. Changing the header or windows re-merges
+    every student.
+    '''
+    import hashlib
+    import json
+    import shutil
+
+    print("Preparing to synchronize files...")
+    header = ['Special Event Marker'] + log_data[0] + affect_data[0] + qrf_data[0]
+    config = json.dumps([header, None if windows is None else
+                         dict((k, vars(v)) for k, v in sorted(windows.items()))], default=str)
+
+    os.makedirs(segment_dir, exist_ok=True)
+    manifest_path = os.path.join(segment_dir, "manifest.json")
+    students = {}
+    if os.path.exists(manifest_path):
+        with open(manifest_path, 'r') as f:
+            manifest = json.load(f)
+        if manifest["config"] == config:
+            students = manifest["students"]
+        else:
+            print("The output settings have changed; every student will be merged again.")
+
+    def save_manifest():
+        with open(manifest_path + ".tmp", 'w') as f:
+            json.dump({"config": config, "students": students}, f)
+        os.replace(manifest_path + ".tmp", manifest_path)
+
+    with stage(report, "group", len(log_data) + len(affect_data) + len(qrf_data) - 3) as rec:
+        log_groups, aff_groups, qrf_groups = group_students(log_data, qrf_data, affect_data)
+
+        sids = sorted(log_groups)
+        prints = dict((sid, student_fingerprint(log_groups[sid], aff_groups.get(sid, []), qrf_groups.get(sid, [])))
+                      for sid in sids)
+        changed = [sid for sid in sids if sid not in students or students[sid]["fingerprint"] != prints[sid]
+                   or not os.path.exists(os.path.join(segment_dir, students[sid]["segment"]))]
+        rec["rows_out"] = sum(len(log_groups[sid]) + len(aff_groups.get(sid, [])) + len(qrf_groups.get(sid, []))
+                              for sid in changed)
+
+    print(f"Found {len(sids)} student IDs in log data; {len(changed)} have new or changed data.")
+
+    for sid in set(students) - set(sids):
+        # students no longer in the log data
+        segment = os.path.join(segment_dir, students.pop(sid)["segment"])
+        if os.path.exists(segment):
+            os.remove(segment)
+    for sid in changed:
+        students.pop(sid, None)
+    save_manifest()  # so an interrupted run can't leave a changed student marked as up to date
+
+    students_changed = [(sid, log_groups[sid], aff_groups.get(sid, []), qrf_groups.get(sid, [])) for sid in changed]
+
+    with stage(report, "merge", sum(len(x) for s in students_changed for x in s[1:])) as rec:
+        nrows = 0
+        try:
+            for sid, rows, sid_qrf, sid_aff in merge_students(students_changed, n_workers, windows, report):
+                segment = hashlib.sha1(sid.encode('utf-8')).hexdigest()[:16] + ".csv"
+                with open(os.path.join(segment_dir, segment + ".tmp"), 'w', newline="") as f:
+                    csv.writer(f).writerows(rows)
+                os.replace(os.path.join(segment_dir, segment + ".tmp"), os.path.join(segment_dir, segment))
+                students[sid] = {"fingerprint": prints[sid], "segment": segment, "rows": len(rows),
+                                 "qrf_synched": sid_qrf, "aff_synched": sid_aff}
+                nrows += len(rows)
+        finally:
+            save_manifest()
+        rec["rows_out"] = nrows
+
+    with stage(report, "assemble", len(sids)) as rec:
+        with open(output_name, 'w', newline="") as f:
+            csv.writer(f).writerow(header)
+        with open(output_name, 'ab') as out:
+            for sid in sids:
+                with open(os.path.join(segment_dir, students[sid]["segment"]), 'rb') as f:
+                    shutil.copyfileobj(f, out, 1 << 22)
+        rec["rows_out"] = sum(students[sid]["rows"] for sid in sids)
+
+    # QRF and affect rows belong to a single student, so the totals add up across students
+    qrf_total = len(set(tuple(x) for x in qrf_data[1:]))
+    aff_total = distinct_rows(aff_groups)
+    print(f"QRF log observations that have not been synched: "
+          f"{qrf_total - sum(students[sid]['qrf_synched'] for sid in sids)}.")
+    print(f"Total QRF log observations: {qrf_total}.")
+    print(f"Affective observations that have not been synched: "
+          f"{aff_total - sum(students[sid]['aff_synched'] for sid in sids)}.")
+    print(f"Total affective observations: {aff_total}.")
+
+def read_csv_rows(path):
+    '''
+    Yields the rows of a CSV file one at a time, header first, without reading the whole file into memory.
+    '''
+    with open(path,'r') as f:
+        yield from csv.reader(f)
+
+def iter_student_groups(data,column,exclude=()):
+    '''
+    Groups a stream of rows that is sorted by student ID, yielding (student ID, rows) one student at a time.
+    data: an iterable of rows, without a header
+    column: the index position of the column containing the student ID
+    exclude: values of the first column to drop, such as test IDs
+    Raises ValueError if the stream is not sorted by student ID.
+    '''
+    sid = None
+    group = []
+    for i in data:
+        if i[0] in exclude:
             continue
+        if i[column] != sid:
+            if group:
+                yield sid, group
+            if sid is not None and i[column] < sid:
+                raise ValueError(f"Rows must be sorted by student ID; found {i[column]} after {sid}.")
+            sid = i[column]
+            group = []
+        group.append(i)
+    if group:
+        yield sid, group
 
-        log_subset = [x for x in log_data[1:] if x[1] == sid]
-        aff_subset = [x for x in affect_data[1:] if x[1] == sid]
-        qrf_subset = [x for x in qrf_data[1:] if x[5] == sid]
+def stream_synchronization(log_rows,qrf_data,affect_rows,output_name,affect_logits=None,affect_steps=None,
+                           batch_rows=100000,buffer_size=1 << 20,windows=None,report=None):
+    '''
+    Streaming equivalent of synchronization_main for log and affect data too large to hold in memory.
+    log_rows: an iterable of log rows, header first, sorted by student ID (column 0)
+    qrf_data: an array containing linked qrf and transcript code data
+    affect_rows: an iterable of affect rows, header first, sorted by student ID (column 1)
+    output_name: the path to write synchronized output to
+    affect_logits, affect_steps: if given, affect rows are raw and each student's rows are cleaned with
+    preprocess_affect as they are read, using these logit and stepwise regression columns
+    batch_rows: the number of output rows to buffer between writes
+    buffer_size: the size of the output file buffer, in bytes
+    windows: as for synchronization_main
+    report: a SyncReport to record every student's merge in; the caller times the run as a whole
+    Only one student's log and affect rows are held at a time, so peak memory scales with the largest single
+    student. Students are written in sorted order; each student's rows match synchronization_main.
+    '''
+    log_rows = iter(log_rows)
+    affect_rows = iter(affect_rows)
+    log_header = next(log_rows)
+    affect_header = next(affect_rows)
+    clean = affect_logits is not None or affect_steps is not None
+    if clean:
+        affect_header = affect_header + ['Predicted Affect']
 
-        log_subset.sort(key=itemgetter(7))
-        aff_subset.sort(key=itemgetter(0))
-        qrf_subset.sort(key=itemgetter(-2))
+    qrf_groups = group_by_student(qrf_data[1:],5)
+    qrf_synched = 0
+    aff_total = 0
+    aff_synched = 0
 
-        aff_i = 0
-        tscr_i = 0
+    print("Preparing to synchronize files...")
+    with open(output_name, 'w', newline="", buffering=buffer_size) as f:
+        writer = csv.writer(f)
+        writer.writerow(['Special Event Marker'] + log_header + affect_header + qrf_data[0])
 
-        for n, i in enumerate(log_subset):
-            i[7] = int(i[7])
+        affect_groups = iter_student_groups(affect_rows, 1, TEST_IDS)
+        aff_sid, aff_group = next(affect_groups, (None, None))
 
-            if n == len(log_subset)-1:
-                break
+        def take_affect(sid):
+            # advances the affect stream up to sid, returning sid's cleaned rows; students skipped on the way
+            # have no log data, so all of their affect rows count as unsynched
+            nonlocal aff_sid, aff_group, aff_total
+            group = []
+            while aff_sid is not None and (sid is None or aff_sid <= sid):
+                if clean:
+                    aff_group = preprocess_affect([affect_header[:-1]] + aff_group, affect_logits or [],
+                                                  affect_steps or [], verbose=False)[1:]
+                if aff_sid == sid:
+                    group = aff_group
+                aff_total += len(set(tuple(x) for x in aff_group))
+                aff_sid, aff_group = next(affect_groups, (None, None))
+            return group
 
-            if sid in unique_qrf:
-                while int(i[7]) > int(qrf_subset[tscr_i][-1])*1000 + (3600*1000) and tscr_i < len(qrf_subset)-1:
-                    if tscr_i == len(qrf_subset)-1:
-                        continue
-                    else:
-                        tscr_i += 1
+        def students():
+            # read lazily by merge_students, so only one student's rows are held at a time
+            for sid, log_subset in iter_student_groups(log_rows, 0, TEST_IDS):
+                yield sid, log_subset, take_affect(sid), qrf_groups.get(sid, [])
 
-            while int(i[7]) > int(aff_subset[aff_i][9]) and aff_i < len(aff_subset)-1:
-                if aff_i == len(aff_subset)-1:
-                    continue
-                else:
-                    aff_i += 1
+        batch = []
+        nstudents = 0
+        for sid, rows, sid_qrf, sid_aff in merge_students(students(), windows=windows, report=report):
+            qrf_synched += sid_qrf
+            aff_synched += sid_aff
+            nstudents += 1
 
-            while int(aff_subset[aff_i][9]) - int(i[7]) > 20000 and int(aff_subset[aff_i][9]) < int(log_subset[n+1][7]):
-                if aff_i == len(aff_subset)-1 or n == len(log_subset)-1:
-                    continue
+            batch.extend(rows)
+            if len(batch) >= batch_rows:
+                writer.writerows(batch)
+                batch = []
+        take_affect(None)
+        writer.writerows(batch)
 
-                dummy_logs = ['Unpaired Affective Prediction',i[1]]
-                dummy_logs.extend(['']*63)
-                dummy_logs.extend(aff_subset[aff_i])
-                writer.writerow(dummy_logs)
-                aff_i += 1
+    qrf_total = len(set(tuple(x) for x in qrf_data[1:]))
+    print(f"Synchronized {nstudents} student IDs from log data.")
+    print(f"QRF log observations that have not been synched: {qrf_total - qrf_synched}.")
+    print(f"Total QRF log observations: {qrf_total}.")
+    print(f"Affective observations that have not been synched: {aff_total - aff_synched}.")
+    print(f"Total affective observations: {aff_total}.")
+
+def file_fingerprint(path,known=None):
+    '''
+    Identifies the contents of an input file by [path, size, mtime, sha1 hash].
+    known: previously computed fingerprints, keyed by path. If the size and mtime are unchanged the recorded hash
+    is reused, so unchanged inputs aren't reread on every run.
+    '''
+    import hashlib
+
+    path = os.path.abspath(path)
+    st = os.stat(path)
+    if known and path in known and known[path][1:3] == [st.st_size, st.st_mtime_ns]:
+        return known[path]
+
+    digest = hashlib.sha1()
+    with open(path,'rb') as f:
+        for block in iter(lambda: f.read(1 << 20), b''):
+            digest.update(block)
+    return [path, st.st_size, st.st_mtime_ns, digest.hexdigest()]
+
+def save_table(data,path):
+    '''
+    Writes an array of rows (header first) to a directory in a memory-mappable columnar format: one .npy array per
+    column, plus the row lengths. Columns of only ints or only floats are stored as int64/float64, and columns of
+    only strings as fixed-width unicode. Columns that mix types, or whose longest string would more than double
+    the size of a fixed-width array, are pickled as a list instead.
+    '''
+    import json
+    import pickle
+    import numpy as np
+
+    os.makedirs(path, exist_ok=True)
+    rows = data[1:]
+    lengths = np.array([len(x) for x in rows], dtype=np.int32)
+    np.save(os.path.join(path, "lengths.npy"), lengths)
+    kinds = []
 
-            if n < len(log_subset)-1:
-                if sid in unique_qrf:
-                    if int(i[7]) <= int(qrf_subset[tscr_i][-2])*1000 + 3600*1000 <= int(log_subset[n + 1][7]):
-                        i[82:] = qrf_subset[tscr_i]
-                        i[0] = "Observation Assigned"
+    for j in range(int(lengths.max()) if len(rows) else 0):
+        cells = [x[j] if len(x) > j else "" for x in rows]
+        types = set(type(x) for x in cells)
+        values = None
+        if types == {int}:
+            try:
+                values = np.array(cells, dtype=np.int64)
+            except OverflowError:
+                pass
+        elif types == {float}:
+            values = np.array(cells, dtype=np.float64)
+        elif types == {str}:
+            sizes = [len(x) for x in cells]
+            # numpy drops trailing NULs from fixed-width strings, so those columns are pickled
+            if max(sizes) * len(cells) <= 2 * sum(sizes) + (1 << 20) and not any(x.endswith('\0') for x in cells):
+                values = np.array(cells, dtype=f"U{max(1, max(sizes))}")
 
-                    if int(i[7]) <= int(qrf_subset[tscr_i][-1])*1000 + 3600*1000 <= int(log_subset[n + 1][7]):
-                        i[82:] = qrf_subset[tscr_i]
-                        i[0] = "Observation Started"
-                        qrf_s.append(qrf_subset[tscr_i])
+        if values is None:
+            kinds.append('p')
+            with open(os.path.join(path, f"c{j}.pkl"), 'wb') as f:
+                pickle.dump(cells, f, protocol=pickle.HIGHEST_PROTOCOL)
+        else:
+            kinds.append(values.dtype.kind)
+            np.save(os.path.join(path, f"c{j}.npy"), values)
 
-                if 0 <= int(aff_subset[aff_i][9]) - int(i[7]) <= 20000:
-                    i[65:82] = aff_subset[aff_i]
-                    aff_s.append(aff_subset[aff_i])
+    with open(os.path.join(path, "meta.json"), 'w') as f:
+        json.dump({"header": data[0], "nrows": len(rows), "kinds": kinds}, f)
 
-            writer.writerow(i)
+def load_table(path):
+    '''
+    Reads a table written by save_table back into an array of rows, header first. Each array column is memory-mapped
+    and converted to Python values in one call, and pickled columns are read in one call, so no CSV text is parsed
+    and no timestamps are converted again. The sync functions work on lists of rows, so the rows themselves are
+    still built in memory; garbage collection is paused while they are, as it would otherwise rescan the millions
+    of new cells over and over.
+    '''
+    import gc
+    import json
+    import pickle
+    import numpy as np
+
+    with open(os.path.join(path, "meta.json"), 'r') as f:
+        meta = json.load(f)
+    lengths = np.load(os.path.join(path, "lengths.npy"))
+
+    enabled = gc.isenabled()
+    gc.disable()
+    try:
+        columns = []
+        for j, kind in enumerate(meta["kinds"]):
+            if kind == 'p':
+                with open(os.path.join(path, f"c{j}.pkl"), 'rb') as f:
+                    columns.append(pickle.load(f))
+            else:
+                columns.append(np.load(os.path.join(path, f"c{j}.npy"), mmap_mode='r').tolist())
 
-    qrf_set = set(tuple(x) for x in qrf_data[1:])
-    syn_set = set(tuple(x) for x in qrf_s)
-    inters = qrf_set - syn_set
-    print(f"QRF log observations that have not been synched: {len(inters)}.")
-    print(f"Total QRF log observations: {len(qrf_set)}.")
+        rows = list(map(list, zip(*columns))) if columns else [[] for _ in range(meta["nrows"])]
+        del columns
+        if len(rows) and lengths.min() < len(meta["kinds"]):
+            for row, n in zip(rows, lengths.tolist()):
+                del row[n:]
+    finally:
+        if enabled:
+            gc.enable()
+    return [meta["header"]] + rows
+
+def cached_source(cache_dir,stage,inputs,build,params=()):
+    '''
+    Returns a cleaned data source from the on-disk cache if its inputs are unchanged, otherwise builds it with
+    build() and caches the result.
+    cache_dir: the cache directory; if None, build() is always called
+    stage: a name for the source, such as "affect"
+    inputs: the files, or directories of files, the source is built from
+    build: a function taking no arguments that returns the source as an array of rows, header first
+    params: any settings that affect the output of build(), which are also part of the cache key
+
+    Entries are keyed by the fingerprint of every input, so changed inputs miss the cache and their stale
+    entries are removed when the new one is written.
+    '''
+    import hashlib
+    import json
+    import shutil
+
+    if cache_dir is None:
+        return build()
+
+    os.makedirs(cache_dir, exist_ok=True)
+    known_path = os.path.join(cache_dir, "fingerprints.json")
+    known = {}
+    if os.path.exists(known_path):
+        with open(known_path, 'r') as f:
+            known = json.load(f)
+
+    files = []
+    for x in inputs:
+        if os.path.isdir(x):
+            files.extend(os.path.join(x, j) for j in sorted(os.listdir(x)))
+        else:
+            files.append(x)
+    prints = [file_fingerprint(x, known) for x in files]
+    known.update((x[0], x) for x in prints)
+    with open(known_path, 'w') as f:
+        json.dump(known, f)
 
-    aff_set = set(tuple(x) for x in affect_data[1:])
-    syn_set = set(tuple(x) for x in aff_s)
+    key = hashlib.sha1(json.dumps([stage, prints, list(params)]).encode('utf-8')).hexdigest()[:16]
+    entry = os.path.join(cache_dir, f"{stage}-{key}")
+    if os.path.exists(os.path.join(entry, "meta.json")):
+        print(f"Loading cached {stage} data...")
+        return load_table(entry)
 
-    inters = aff_set - syn_set
-    print(len([x for x in inters if x[1] == "A50"]))
-    print(f"Affective observations that have not been synched: {len(inters)}.")
-    print(f"Total affective observations: {len(aff_set)}.")
+    data = build()
+    for j in os.listdir(cache_dir):
+        if j.startswith(stage + "-"):
+            shutil.rmtree(os.path.join(cache_dir, j))
+    save_table(data, entry + ".tmp")
+    os.replace(entry + ".tmp", entry)
+    return data
 
 if __name__ == "__main__":
     # affect_input = "D:\\BettyBrain\\Project Data\\Affect Data\\Dec_2018_affect_cleaned_Oct20.csv"
@@ -288,29 +1414,91 @@ if __name__ == "__main__":
     # affect_format_old = "%m/%d/%Y %H:%M:%S"
     affect_format = "%Y-%m-%d %H:%M:%S"
 
-    with open(affect_input,'r') as f:
-        reader = list(csv.reader(f))
-        reader[0].append('Predicted Affect')
-
-    print(f"Affective records before parsing empty predictions: {len(reader)}.")
-    reader = parse_empty_predictions(reader)
-    print(f"Affective records after parsing empty predictions: {len(reader)}.")
-    # reader = time_convert(reader,7,affect_format,21600)
-    # new affect data is UTC; converting datetime to timestamp is legacy
-    # new timestamp index is 9
-    reader = logit_to_prob(reader,[10,11,12,13,15])
-    reader = trim_step_regression(reader,[14])
-    reader = get_affect_prediction(reader)
-    affect = reader
-
-    with open(transcript_code_input,'r') as f:
-        reader = list(csv.reader(f))
-        qrf = link_qrf_intcode(qrf_input,reader)
+    # stream the log and affect files instead of reading them into memory; both must be sorted by student ID
+    stream_sync = False
+
+    # number of processes to merge students across; None merges them one at a time
+    sync_workers = None
+
+    # matching windows for affect and QRF events, e.g. DEFAULT_WINDOWS; None keeps the original fixed cursors
+    sync_windows = None
+
+    # directory for cached, parsed copies of the inputs; None parses the CSVs on every run
+    cache_dir = None
+
+    # directory of per-student output segments; if set, only students with new or changed data are merged again
+    segment_dir = None
+
+    # where to write a JSON report of time, rows and memory per stage and per student; None skips it
+    report_path = None
+    # stages to run under cProfile, e.g. ["merge"], written next to the report; True profiles every stage
+    profile_stages = []
+
+    report = None
+    if report_path:
+        report = SyncReport(profile_stages, os.path.dirname(os.path.abspath(report_path)))
 
-    with open(logs_input,'r') as f:
-        logs = list(csv.reader(f))
+    # rows read from each input file, for the report; sources loaded from the cache read the cached rows instead
+    rows_read = {}
+
+    def build_qrf():
+        with open(transcript_code_input,'r') as f:
+            reader = list(csv.reader(f))
+        rows_read["qrf"] = len(reader) - 1
+        return link_qrf_intcode(qrf_input,reader)
+
+    def build_affect():
+        with stage(report, "affect_parse") as rec:
+            with open(affect_input,'r') as f:
+                reader = list(csv.reader(f))
+                reader[0].append('Predicted Affect')
+            rows_read["affect"] = rec["rows_in"] = rec["rows_out"] = len(reader) - 1
+
+        print(f"Affective records before parsing empty predictions: {len(reader)}.")
+        # reader = time_convert(reader,7,affect_format,21600)
+        # new affect data is UTC; converting datetime to timestamp is legacy
+        # new timestamp index is 9
+        with stage(report, "affect_clean", len(reader) - 1) as rec:
+            cleaned = preprocess_affect(reader,[10,11,12,13,15],[14])
+            rec["rows_out"] = len(cleaned) - 1
+        return cleaned
+
+    def build_logs():
+        with open(logs_input,'r') as f:
+            data = list(csv.reader(f))
+        rows_read["logs"] = len(data) - 1
+        return data
+
+    with stage(report, "qrf") as rec:
+        qrf = cached_source(cache_dir, "qrf", [transcript_code_input, qrf_input], build_qrf)
+        rec["rows_in"] = rows_read.get("qrf", len(qrf) - 1)
+        rec["rows_out"] = len(qrf) - 1
+
+    if stream_sync:
+        with stage(report, "stream"):
+            stream_synchronization(read_csv_rows(logs_input), qrf, read_csv_rows(affect_input), synch_output,
+                                   affect_logits=[10,11,12,13,15], affect_steps=[14], windows=sync_windows,
+                                   report=report)
+    else:
+        with stage(report, "affect") as rec:
+            affect = cached_source(cache_dir, "affect", [affect_input], build_affect,
+                                   params=[[10,11,12,13,15], [14]])
+            rec["rows_in"] = rows_read.get("affect", len(affect) - 1)
+            rec["rows_out"] = len(affect) - 1
+        with stage(report, "logs") as rec:
+            logs = cached_source(cache_dir, "logs", [logs_input], build_logs)
+            rec["rows_in"] = rows_read.get("logs", len(logs) - 1)
+            rec["rows_out"] = len(logs) - 1
+
+        if segment_dir:
+            incremental_synchronization(logs, qrf, affect, synch_output, segment_dir, n_workers=sync_workers,
+                                        windows=sync_windows, report=report)
+        else:
+            synchronization_main(logs, qrf, affect, synch_output, n_workers=sync_workers, windows=sync_windows,
+                                 report=report)
 
-    synchronization_main(logs, qrf, affect, synch_output)
+    if report is not None:
+        report.write(report_path)
 
 '''
     with open(synch_output,'r') as f:
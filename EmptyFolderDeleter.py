@@ -1,9 +1,15 @@
 '''
 This program finds empty folders in a specified directory and deletes them.
 
-This program will not delete empty nested folders.
+The whole tree under the directory is searched, and folders that only hold
+empty folders are deleted too, deepest first. Each level of the tree is
+scanned with os.scandir across a pool of threads, so very large trees can be
+pruned quickly. The directory itself is never deleted.
 
-This program does not exhaustively search directory trees.
+Set dry_run to True to list the folders that would be deleted without
+deleting anything. Folders whose name or path (relative to the directory)
+matches one of the exclude patterns, e.g. ".git" or "raw/*", are neither
+searched nor deleted, and the folders containing them are kept.
 
 It has been very lightly tested.
 
@@ -12,14 +18,103 @@ Use at your own risk.
 '''
 
 import os
+import stat
+import time
+from fnmatch import fnmatch
+from concurrent.futures import ThreadPoolExecutor
 
-loc = "C:/Users/Stefan/Desktop/EFDTEst"
-folders = os.listdir(loc)
 
-for f in folders:
-    loc_mod = loc+"/"+f
-    if os.path.isdir(loc_mod) and os.listdir(loc_mod) == []:
-        os.rmdir(loc_mod)
+def is_junction(e):
+    '''
+    True if a directory entry is a Windows junction or other reparse point
+    that is_dir(follow_symlinks=False) still reports as a folder. These can
+    point anywhere, so prune never descends into or deletes them.
+    '''
+    if os.name != 'nt':
+        return False
+    if hasattr(e,'is_junction') and e.is_junction():
+        return True
+    attrs = getattr(e.stat(follow_symlinks=False),'st_file_attributes',0)
+    return bool(attrs & stat.FILE_ATTRIBUTE_REPARSE_POINT)
+
+def scan(path,root,exclude=()):
+    '''
+    Lists the subfolders of path that may be pruned, and counts everything
+    else in it: files, links, junctions and excluded folders. A folder that
+    can't be read is counted as holding something, so it's never deleted.
+    '''
+    subdirs = []
+    other = 0
+    try:
+        with os.scandir(path) as it:
+            for e in it:
+                if e.is_dir(follow_symlinks=False) and not is_junction(e):
+                    rel = os.path.relpath(e.path,root).replace(os.sep,"/")
+                    if not any(fnmatch(e.name,p) or fnmatch(rel,p) for p in exclude):
+                        subdirs.append(e.path)
+                        continue
+                other += 1
+    except OSError:
+        other += 1
+    return subdirs,other
+
+def remove(path,dry_run=False):
+    '''
+    Deletes an empty folder, returning False if it couldn't be deleted (for
+    example, because something was written to it since it was scanned).
+    '''
+    if dry_run:
+        return True
+    try:
+        os.rmdir(path)
+        return True
+    except OSError:
+        return False
+
+def prune(loc,dry_run=False,exclude=(),n_threads=16):
+    '''
+    Deletes every folder under loc that is empty, or becomes empty once the
+    empty folders inside it are deleted. Returns the folders deleted (or that
+    would be, in a dry run) and the number of folders scanned.
+    '''
+    levels = [] # per depth: (paths, index of each path's parent, other entries)
+    paths,parents = [loc],[-1]
+    with ThreadPoolExecutor(n_threads) as pool:
+        while paths:
+            res = list(pool.map(lambda p: scan(p,loc,exclude),paths))
+            levels.append((paths,parents,[x[1] for x in res]))
+            paths = [d for subdirs,_ in res for d in subdirs]
+            parents = [n for n,(subdirs,_) in enumerate(res) for _ in subdirs]
+
+        removed = []
+        kept = [0]*len(levels[-1][0]) # kept subfolders of each folder
+        for depth in range(len(levels)-1,0,-1):
+            paths,parents,other = levels[depth]
+            empty = [n for n in range(len(paths)) if other[n] == 0 and kept[n] == 0]
+            gone = set(n for n,ok in zip(empty,pool.map(lambda n: remove(paths[n],dry_run),empty))
+                       if ok)
+            removed.extend(paths[n] for n in empty if n in gone)
+            kept = [0]*len(levels[depth-1][0])
+            for n,parent in enumerate(parents):
+                if n not in gone:
+                    kept[parent] += 1
+    return removed,sum(len(x[0]) for x in levels)
+
+
+if __name__ == "__main__":
+    loc = "C:/Users/Stefan/Desktop/EFDTEst"
+    dry_run = False # set to True to list empty folders without deleting them
+    exclude = [] # folder names or relative paths to leave alone, e.g. [".git","raw/*"]
+    n_threads = 16
+
+    tic = time.perf_counter()
+    removed,scanned = prune(loc,dry_run,exclude,n_threads)
+    toc = time.perf_counter()
+
+    for f in removed:
+        print(("would delete " if dry_run else "deleted ")+f)
+    print(f"{scanned} folders scanned in {toc-tic:.2f}s ({scanned/max(toc-tic,1e-9):,.0f} folders/sec), "
+          f"{len(removed)} {'would be ' if dry_run else ''}deleted")
 
 '''
 *** MIT LICENSE INFORMATION ***
@@ -1,45 +1,250 @@
+import json
+import os
+
 import pandas as pd
 import matplotlib.pyplot as plt
 
-from sklearn.feature_extraction.text import TfidfVectorizer, CountVectorizer
+from sklearn.feature_extraction.text import CountVectorizer
 from sklearn.decomposition import NMF, MiniBatchNMF, LatentDirichletAllocation
 
-f_name = r"C:\Users\Stefan\Documents\MiscWorkProjects\Textual Information_Ning_UTD.csv"
-df = pd.read_csv(f_name)
+VECTORIZER = dict(max_df=0.95, min_df=2, max_features=1000, stop_words='english')
+LDA = dict(max_iter=5, learning_method="online", learning_offset=50.0, random_state=0)
+
+
+def _column_cache(f_name, column, cache_dir, vectorizer):
+    """
+    Returns the cache key for one text column, made from the file's path, size
+    and mtime and the vectorizer settings, with the paths of its cached matrix
+    and vocabulary.
+    """
+    stat = os.stat(f_name)
+    key = {"file": os.path.abspath(f_name), "size": stat.st_size,
+           "mtime": stat.st_mtime, "column": column, "vectorizer": vectorizer}
+    return (key, os.path.join(cache_dir, f"{column}_tf.npz"),
+            os.path.join(cache_dir, f"{column}_vocab.json"))
+
+
+def cached_column(f_name, column, cache_dir, vectorizer=VECTORIZER):
+    """
+    Returns the paths of the cached matrix and vocabulary for one text column
+    if they were built from the same file with the same vectorizer settings,
+    otherwise None. Only the file's metadata is read, not the file itself.
+    """
+    key, tf_path, vocab_path = _column_cache(f_name, column, cache_dir, vectorizer)
+    if os.path.exists(tf_path) and os.path.exists(vocab_path):
+        with open(vocab_path) as f:
+            if json.load(f)["key"] == key:
+                return tf_path, vocab_path
+    return None
+
+
+def vectorize_column(f_name, df, column, cache_dir, vectorizer=VECTORIZER):
+    """
+    Builds the doc-term count matrix and vocabulary for one text column, or
+    loads them from cache_dir if they were already built from the same file
+    with the same vectorizer settings. Returns the paths of the cached matrix
+    and vocabulary.
+    """
+    import scipy.sparse
+
+    cached = cached_column(f_name, column, cache_dir, vectorizer)
+    if cached:
+        return cached
 
-df_a1 = df['attention_1']
-df_a2 = df['attention_2']
-df_pbe = df['pbe_2']
-df_know = df['knowledge_1']
+    key, tf_path, vocab_path = _column_cache(f_name, column, cache_dir, vectorizer)
+    tf_vectorizer = CountVectorizer(**vectorizer)
+    tf = tf_vectorizer.fit_transform(df[column].dropna())
+    os.makedirs(cache_dir, exist_ok=True)
+    scipy.sparse.save_npz(tf_path, tf)
+    with open(vocab_path, "w") as f:
+        json.dump({"key": key,
+                   "vocab": tf_vectorizer.get_feature_names_out().tolist()}, f)
+    return tf_path, vocab_path
 
-data = df_a1
 
-data.dropna(inplace=True)
+_matrices = {}
 
-topics = list(range(1, 10, 1))
-topwords = 3
 
-tfidf_vectorizer = TfidfVectorizer(max_df=0.95, min_df=2, max_features=1000, stop_words='english')
-tfidf = tfidf_vectorizer.fit_transform(data)
+def _init_worker(paths):
+    """
+    Loads each column's cached matrix and vocabulary once per worker process,
+    so the sweep only sends column names and topic counts to the workers.
+    """
+    import scipy.sparse
 
-tf_vectorizer = CountVectorizer(max_df=0.95, min_df=2, max_features=1000, stop_words='english')
-tf = tf_vectorizer.fit_transform(data)
+    for column, (tf_path, vocab_path) in paths.items():
+        with open(vocab_path) as f:
+            _matrices[column] = (scipy.sparse.load_npz(tf_path), json.load(f)["vocab"])
 
-for i in topics:
-    print("")
-    print(f"Top Five Terms for {i} Topic(s).")
-    lda = LatentDirichletAllocation(
-        n_components=i,
-        max_iter=5,
-        learning_method="online",
-        learning_offset=50.0,
-        random_state=0,
-    )
 
+def _fit_config(task):
+    """
+    Fits LDA with n topics to one column and returns its perplexity and the
+    top words of each topic.
+    """
+    import time
+
+    column, n, topwords, lda_settings = task
+    tf, vocab = _matrices[column]
+    tic = time.perf_counter()
+    lda = LatentDirichletAllocation(n_components=n, **lda_settings)
     lda.fit(tf)
-    tf_feature_names = tf_vectorizer.get_feature_names_out()
+    return {"column": column, "topics": n, "perplexity": lda.perplexity(tf),
+            "seconds": time.perf_counter() - tic,
+            "top_words": " | ".join(", ".join(x) for x in top_words(lda, vocab, topwords))}
+
 
-    for topic_idx, topic in enumerate(lda.components_):
+def top_words(model, vocab, topwords=3):
+    """
+    Returns the topwords highest-weighted words of each topic of a fitted
+    LDA or NMF model.
+    """
+    top = []
+    for topic in model.components_:
         top_features_ind = topic.argsort()[: -topwords -1 : -1]
-        top_features = [tf_feature_names[i] for i in top_features_ind]
-        print(top_features)
\ No newline at end of file
+        top.append([vocab[i] for i in top_features_ind])
+    return top
+
+
+def topic_sweep(f_name, columns, topics, topwords=3, cache_dir="lda_cache",
+                n_jobs=None, vectorizer=VECTORIZER, lda_settings=LDA):
+    """
+    Fits LDA for every (column, topic count) pair and returns a table with the
+    perplexity and top words of each fit, sorted by column and topic count.
+    Each column is vectorized once and cached in cache_dir, and the file is
+    only read for columns that aren't cached yet; the fits then run across
+    n_jobs processes (all cores by default), each of which loads the cached
+    matrices once.
+    """
+    from concurrent.futures import ProcessPoolExecutor
+
+    paths = dict((c, cached_column(f_name, c, cache_dir, vectorizer)) for c in columns)
+    missing = [c for c in columns if paths[c] is None]
+    if missing:
+        df = pd.read_csv(f_name, usecols=missing)
+        paths.update((c, vectorize_column(f_name, df, c, cache_dir, vectorizer)) for c in missing)
+        del df
+
+    # the largest fits go first, so they don't hold up the end of the sweep
+    tasks = sorted(((c, n, topwords, lda_settings) for c in columns for n in topics),
+                   key=lambda x: -x[1])
+    with ProcessPoolExecutor(n_jobs, initializer=_init_worker, initargs=(paths,)) as pool:
+        res = list(pool.map(_fit_config, tasks))
+    return pd.DataFrame(res).sort_values(["column", "topics"]).reset_index(drop=True)
+
+
+def stream_vocab(f_name, column, chunksize=10000, vectorizer=VECTORIZER):
+    """
+    First pass of the streaming mode: reads the column in chunks and counts
+    how many documents each term appears in and how often, then applies the
+    vectorizer's max_df, min_df and max_features the way CountVectorizer
+    would on the whole column. Returns the vocabulary and the number of
+    documents.
+    """
+    from collections import Counter
+
+    analyze = CountVectorizer(**vectorizer).build_analyzer()
+    doc_freq = Counter()
+    term_freq = Counter()
+    ndocs = 0
+    for chunk in pd.read_csv(f_name, usecols=[column], chunksize=chunksize):
+        for doc in chunk[column].dropna():
+            terms = analyze(doc)
+            term_freq.update(terms)
+            doc_freq.update(set(terms))
+            ndocs += 1
+
+    max_df, min_df = vectorizer.get("max_df", 1.0), vectorizer.get("min_df", 1)
+    max_doc = max_df if isinstance(max_df, int) else max_df * ndocs
+    min_doc = min_df if isinstance(min_df, int) else min_df * ndocs
+    terms = [x for x, n in doc_freq.items() if min_doc <= n <= max_doc]
+    if vectorizer.get("max_features"):
+        # ties at the cutoff are broken alphabetically, which CountVectorizer
+        # doesn't guarantee, so those few terms can differ from a full fit
+        terms = sorted(terms, key=lambda x: (-term_freq[x], x))[:vectorizer["max_features"]]
+    return sorted(terms), ndocs
+
+
+def stream_topics(f_name, column, n_components, model="lda", chunksize=10000,
+                  epochs=1, checkpoint=None, vectorizer=VECTORIZER, lda_settings=LDA):
+    """
+    Out-of-core topic model for columns too large to hold in memory. Builds
+    the vocabulary with stream_vocab, then makes epochs passes over the file,
+    vectorizing chunksize rows at a time and updating the model with
+    partial_fit. model is "lda" for online LDA or "nmf" for MiniBatchNMF.
+
+    If checkpoint is a file name, the model and its progress are saved there
+    after every chunk, and a later call with the same arguments resumes from
+    the last chunk saved instead of starting over.
+
+    Returns the fitted model and its vocabulary.
+    """
+    import pickle
+
+    stat = os.stat(f_name)
+    key = {"file": os.path.abspath(f_name), "size": stat.st_size, "mtime": stat.st_mtime,
+           "column": column, "n_components": n_components, "model": model,
+           "chunksize": chunksize, "vectorizer": vectorizer, "lda_settings": lda_settings}
+
+    state = None
+    if checkpoint and os.path.exists(checkpoint):
+        with open(checkpoint, "rb") as f:
+            state = pickle.load(f)
+        if state["key"] != key:
+            state = None
+    if state is None:
+        vocab, ndocs = stream_vocab(f_name, column, chunksize, vectorizer)
+        if model == "lda":
+            settings = dict(lda_settings, learning_method="online", total_samples=ndocs)
+            fitter = LatentDirichletAllocation(n_components=n_components, **settings)
+        else:
+            fitter = MiniBatchNMF(n_components=n_components,
+                                  random_state=lda_settings.get("random_state"))
+        state = {"key": key, "vocab": vocab, "model": fitter, "done": 0}
+
+    # the vocabulary is fixed, so only the settings that shape each token apply
+    tf_vectorizer = CountVectorizer(vocabulary=state["vocab"], **dict(
+        (k, v) for k, v in vectorizer.items() if k not in ("max_df", "min_df", "max_features")))
+
+    n = 0
+    for _ in range(epochs):
+        for chunk in pd.read_csv(f_name, usecols=[column], chunksize=chunksize):
+            n += 1
+            if n <= state["done"]:
+                continue # already fitted before the checkpoint
+            docs = chunk[column].dropna()
+            if len(docs):
+                state["model"].partial_fit(tf_vectorizer.transform(docs))
+            state["done"] = n
+            if checkpoint:
+                with open(checkpoint + ".tmp", "wb") as f:
+                    pickle.dump(state, f)
+                os.replace(checkpoint + ".tmp", checkpoint)
+    return state["model"], state["vocab"]
+
+
+if __name__ == "__main__":
+    f_name = r"C:\Users\Stefan\Documents\MiscWorkProjects\Textual Information_Ning_UTD.csv"
+
+    columns = ['attention_1', 'attention_2', 'pbe_2', 'knowledge_1']
+
+    topics = list(range(1, 10, 1))
+    topwords = 3
+
+    stream = False # set to True to fit one column out-of-core instead of sweeping
+    stream_column = 'attention_1'
+    stream_n_topics = 5
+    stream_model = "lda" # "lda" or "nmf"
+    chunksize = 10000 # rows read at a time
+    checkpoint = os.path.splitext(f_name)[0] + f"_{stream_column}_{stream_model}.ckpt"
+
+    if stream:
+        model, vocab = stream_topics(f_name, stream_column, stream_n_topics, stream_model,
+                                     chunksize, checkpoint=checkpoint)
+        for topic in top_words(model, vocab, topwords):
+            print(topic)
+    else:
+        table = topic_sweep(f_name, columns, topics, topwords)
+        with pd.option_context("display.max_colwidth", None, "display.width", 200):
+            print(table[["column", "topics", "perplexity", "top_words"]].to_string(index=False))
+        table.to_csv(os.path.splitext(f_name)[0] + "_topic_sweep.csv", index=False)
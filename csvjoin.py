@@ -1,34 +1,156 @@
+'''
+Joins a number of .csv files into a single .csv file. Rows are streamed from
+each input straight to the output, so files of any size can be joined without
+holding them in memory.
+
+By default every file must have the same header. Set union to True to join
+files whose headers differ; the output then has every column that appears in
+any file, in order of first appearance, and cells a file doesn't have are left
+blank. For files that are known to match, csvconcat copies them byte for byte,
+which is much faster than parsing them.
+'''
+
 import os
 import csv
+import queue
+import shutil
+import threading
+from itertools import islice
+
+
+def read_header(name,delim=","):
+    '''
+    Returns the header row of a .csv file, or None if the file is empty.
+    '''
+    with open(name,'r',newline="") as f:
+        return next(csv.reader(f,delimiter=delim),None)
+
+def read_batches(name,delim=",",batch_rows=50000,threaded=True):
+    '''
+    Yields the rows of a .csv file after its header, in lists of batch_rows rows.
+    If threaded, the file is read on a background thread a few batches ahead of
+    the caller, so reading overlaps with whatever is done with the rows.
+    '''
+    def batches():
+        with open(name,'r',newline="") as f:
+            reader = csv.reader(f,delimiter=delim)
+            next(reader,None) # skipping the header
+            while True:
+                batch = list(islice(reader,batch_rows))
+                if not batch:
+                    return
+                yield batch
+
+    if not threaded:
+        yield from batches()
+        return
+
+    q = queue.Queue(maxsize=4)
+    def produce():
+        try:
+            for batch in batches():
+                q.put(batch)
+        except Exception as e:
+            q.put(e)
+            return
+        q.put(None)
+
+    threading.Thread(target=produce,daemon=True).start()
+    while True:
+        batch = q.get()
+        if batch is None:
+            return
+        if isinstance(batch,Exception):
+            raise batch
+        yield batch
+
+def csvjoin(fnames,joinname,delim=",",union=False,batch_rows=50000,
+            buffer_size=1 << 22,threaded=True):
+    '''
+    Joins fnames into joinname, streaming rows through a buffered writer.
+    fnames:      the .csv files to join, in order
+    joinname:    the name of the joined file
+    delim:       the delimiter used by the input and output files
+    union:       join files with different headers on the union of their columns
+    batch_rows:  the number of rows read and written at a time
+    buffer_size: the size of the output file buffer, in bytes
+    threaded:    read each file on a background thread while writing
+    Raises ValueError if union is False and the headers don't all match.
+    '''
+    headers = [read_header(name,delim) for name in fnames]
+    if union:
+        header = []
+        for h in headers:
+            header.extend(x for x in h or [] if x not in header)
+    else:
+        header = headers[0]
+        for name,h in zip(fnames,headers):
+            if h != header:
+                raise ValueError(f"The header of {name} doesn't match {fnames[0]}: {h}")
+
+    with open(joinname,'w',newline="",buffering=buffer_size) as f:
+        writer = csv.writer(f,delimiter=delim)
+        writer.writerow(header)
+        for name,h in zip(fnames,headers):
+            if h is None:
+                continue
+            remap = None
+            if h != header:
+                remap = [h.index(x) if x in h else None for x in header]
+            for batch in read_batches(name,delim,batch_rows,threaded):
+                if remap:
+                    batch = [[r[i] if i is not None and i < len(r) else "" for i in remap]
+                             for r in batch]
+                writer.writerows(batch)
+
+def csvconcat(fnames,joinname,header=True,buffer_size=1 << 22):
+    '''
+    Fast path for joining files that share a header (or have none): copies the
+    bytes of each file to joinname without parsing them as .csv.
+    header: if True, each file starts with the same header line, which is kept
+            from the first file and skipped in the others
+    Raises ValueError if header is True and a file's header line differs.
+    '''
+    first = None
+    newline = None # taken from the first line of the first file, header or not
+    with open(joinname,'wb') as out:
+        for name in fnames:
+            with open(name,'rb') as f:
+                line = f.readline()
+                if newline is None and line.endswith(b"\n"):
+                    newline = b"\r\n" if line.endswith(b"\r\n") else b"\n"
+                start = 0
+                if header:
+                    if first is None:
+                        first = line
+                    elif line.rstrip(b"\r\n") != first.rstrip(b"\r\n"):
+                        raise ValueError(f"The header of {name} doesn't match {fnames[0]}")
+                    else:
+                        start = f.tell()
+                f.seek(start)
+                shutil.copyfileobj(f,out,buffer_size)
+                if f.tell() > start:
+                    # making sure the next file doesn't run on from this one
+                    f.seek(-1,os.SEEK_END)
+                    if f.read(1) != b"\n":
+                        out.write(newline or b"\n")
+
+
+if __name__ == "__main__":
+    path = "C:\\..." ## Update with the folder path on your system
+    fnames = ["file1.csv",
+              "file2.csv",
+              "file3.csv",
+              "file4.csv"] # Update with file names to join
+
+    joinname = "allfiles.csv" # The name of the joined file
+
+    delim = "," # The delimiter to use (could also be "\t" for tab-delimited files)
+
+    union = False # Set to True to join files whose columns don't all match
 
-path = "C:\..." ## Update with the folder path on your system
-fnames = ["file1.csv",
-          "file2.csv",
-          "file3.csv",
-          "file4.csv"] # Update with file names to join
-
-joinname = "allfiles.csv" # The name of the joined file
-
-delim = "," # The delimiter to use (could also be “\t” for tab-delimited files)
-
-os.chdir(path)
-
-header = None
-join = []
-for name in fnames:
-    with open(name,'rU') as f:
-        reader = csv.reader(f,delimiter=delim)
-        if not header:
-            header = reader.next()
-        else:
-            reader.next()
-            
-        for row in reader:
-            join.append(row)
-
-writer = csv.writer(open(joinname,'wb'))
-writer.writerow(header)
-writer.writerows(join)
+    os.chdir(path)
+    csvjoin(fnames,joinname,delim,union=union)
 
 '''
 Created on Dec 22, 2016
@@ -1,43 +1,258 @@
 '''
 This code accepts a .csv file as input and returns a number of .csv files
 based on user-defined parameters. Useful for taking files that are too large
-for use in traditional graphical spreadsheet programs such as Excel and 
+for use in traditional graphical spreadsheet programs such as Excel and
 making them manageable. To recombine files, try using csvjoin, posted at
 stefanslater.com/code.
+
+Files can be split by row count (split_rows), by size in bytes (split_bytes),
+or into one file per value of a key column such as student or skill
+(split_key). The byte and key modes find chunk boundaries from byte offsets,
+at the end of a line that isn't inside a quoted field, so each chunk of the
+file can be parsed and written by a separate process.
 '''
 
 import csv
+import hashlib
 import os
+import re
+import zlib
+from collections import OrderedDict
 
-def writechunk(d,it):
+def writechunk(d,it,fname=None,header=None,mode='w'):
     '''
     Takes the current string of data and the current file iteration point, and
-    writes it out as a .csv.
+    writes it out as a .csv. fname and header default to the settings of the
+    script below; if no header has been set, it is read from fname. With
+    mode='a', rows are appended to an existing chunk and the header isn't
+    written again.
     '''
+    fname = fname if fname is not None else globals()["fname"]
+    header = header if header is not None else globals().get("header")
+    if header is None:
+        with open(fname,'r',newline="") as f:
+            header = next(csv.reader(f))
     fname_nocsv = fname.split(".")[0] # removing the .csv extension
-    writer = csv.writer(open(fname_nocsv+"_"+str(it)+".csv",'wb'))
-    writer.writerow(header)
-    writer.writerows(d)
-    return 
-
-fname = " " # name of the file to be split
-fdir = " " # the full path of the file to be split
-csvlen = 200000 # the length of the resultant file(s), in rows
-os.chdir(fdir)
-
-with open(fname,'rU') as f:
-    reader = csv.reader(f)
-    header = reader.next()
-    i = 1
-    chunk = []
-    
-    for n,r in enumerate(reader):
-        if n % csvlen == 0 and n != 0:
-            writechunk(chunk,i)
-            i += 1
-            chunk = []
-        chunk.append(r)   
-    writechunk(chunk,i)
+    with open(fname_nocsv+"_"+str(it)+".csv",mode,newline="") as f:
+        writer = csv.writer(f)
+        if mode == 'w':
+            writer.writerow(header)
+        writer.writerows(d)
+    return
+
+def split_rows(fname,csvlen,batch_rows=50000):
+    '''
+    Splits fname into files of csvlen rows each, numbered from 1. Rows are
+    written in batches, so at most batch_rows rows are held in memory.
+    '''
+    with open(fname,'r',newline="") as f:
+        reader = csv.reader(f)
+        header = next(reader)
+        i = 1
+        n = 0 # rows in the current file
+        mode = 'w'
+        chunk = []
+
+        for r in reader:
+            if n == csvlen:
+                writechunk(chunk,i,fname,header,mode)
+                i += 1
+                n = 0
+                mode = 'w'
+                chunk = []
+            elif len(chunk) == batch_rows:
+                writechunk(chunk,i,fname,header,mode)
+                mode = 'a'
+                chunk = []
+            chunk.append(r)
+            n += 1
+        writechunk(chunk,i,fname,header,mode)
+
+def find_boundaries(fname,nbytes,blocksize=1 << 20):
+    '''
+    Finds the byte offsets to split fname at so that each chunk is at least
+    nbytes long. Every offset falls just after a line break that isn't inside
+    a quoted field, so each chunk holds whole records. Returns the offsets,
+    starting with the end of the header and ending with the size of the file.
+    '''
+    bounds = []
+    target = 0 # the first boundary is the end of the header
+    parity = 0 # number of quote characters seen so far, mod 2
+    pos = 0
+    with open(fname,'rb') as f:
+        for block in iter(lambda: f.read(blocksize),b''):
+            i = 0
+            while pos+len(block) > target:
+                j = max(i,target-pos)
+                parity ^= block.count(b'"',i,j) & 1
+                i = j
+                nl = block.find(b'\n',i)
+                while nl >= 0:
+                    parity ^= block.count(b'"',i,nl) & 1
+                    i = nl+1
+                    if not parity:
+                        break
+                    nl = block.find(b'\n',i)
+                if nl < 0:
+                    break # no record ends in the rest of this block
+                bounds.append(pos+i)
+                target = pos+i+nbytes
+            parity ^= block.count(b'"',i) & 1
+            pos += len(block)
+    if not bounds or bounds[-1] != pos:
+        bounds.append(pos)
+    return bounds
+
+def read_range(fname,start,end,encoding="utf-8"):
+    '''
+    Yields the records of fname between two boundaries from find_boundaries.
+    '''
+    def lines():
+        with open(fname,'rb') as f:
+            f.seek(start)
+            pos = start
+            while pos < end:
+                line = f.readline()
+                if not line:
+                    return
+                pos += len(line)
+                yield line.decode(encoding)
+    return csv.reader(lines())
+
+def _write_range(args):
+    '''
+    Writes the records between two boundaries out as a single chunk.
+    '''
+    fname,header,start,end,it = args
+    writechunk(read_range(fname,start,end),it,fname,header)
+    return it
+
+def _shard_name(key,nshards):
+    '''
+    Names the shard a key goes to. Without nshards the name is the key with
+    characters that can't go in a file name replaced, plus a hash of the
+    key itself, so keys like "a/b" and "a_b", or "A1" and "a1" on a case
+    insensitive file system, still get files of their own.
+    '''
+    if nshards:
+        return str(zlib.crc32(key.encode("utf-8")) % nshards)
+    return re.sub(r'[^\w.-]','_',key)+"_"+hashlib.sha1(key.encode("utf-8")).hexdigest()[:16]
+
+def _partition_range(args):
+    '''
+    Partitions the records between two boundaries by key into part files,
+    one per shard, keeping at most max_open of them open at a time. Returns
+    the shards written to, with the keys written to each.
+    '''
+    fname,keycol,nshards,start,end,part,max_open = args
+    fname_nocsv = fname.split(".")[0]
+    handles = OrderedDict() # shard: (file, writer), least recently used first
+    shards = {}
+    try:
+        for r in read_range(fname,start,end):
+            shard = _shard_name(r[keycol],nshards)
+            if shard in handles:
+                handles.move_to_end(shard)
+            else:
+                if len(handles) >= max_open:
+                    handles.popitem(last=False)[1][0].close()
+                f = open(fname_nocsv+"_"+shard+".part"+str(part),
+                         'a' if shard in shards else 'w',newline="")
+                handles[shard] = (f,csv.writer(f))
+                shards.setdefault(shard,set())
+            if not nshards:
+                shards[shard].add(r[keycol])
+            handles[shard][1].writerow(r)
+    finally:
+        for f,_ in handles.values():
+            f.close()
+    return shards
+
+def _pool_map(fn,tasks,workers):
+    if workers > 1:
+        from concurrent.futures import ProcessPoolExecutor
+        with ProcessPoolExecutor(workers) as pool:
+            return list(pool.map(fn,tasks))
+    return list(map(fn,tasks))
+
+def split_bytes(fname,nbytes,workers=1):
+    '''
+    Splits fname into files of roughly nbytes each, numbered from 1, never
+    splitting a record. Chunks are parsed and written across workers processes.
+    '''
+    bounds = find_boundaries(fname,nbytes)
+    with open(fname,'r',newline="") as f:
+        header = next(csv.reader(f))
+    tasks = [(fname,header,a,b,n+1) for n,(a,b) in enumerate(zip(bounds[:-1],bounds[1:]))]
+    return _pool_map(_write_range,tasks,workers)
+
+def split_key(fname,key,nshards=None,workers=1,max_open=64):
+    '''
+    Splits fname by the value of the key column, such as student or skill.
+    Without nshards, each distinct value gets its own file, named after the
+    value (characters that can't go in a file name become underscores) and a
+    hash of it, so no two values share a file; a ValueError is raised if two
+    ever would. With nshards, values are hashed into that many files,
+    numbered from 0.
+
+    The file is cut into one byte range per worker. Each worker writes its
+    records to part files, keeping at most max_open open at a time, and the
+    parts are then joined in order, so every output file keeps the input's
+    row order.
+    '''
+    import shutil
+
+    with open(fname,'r',newline="") as f:
+        header = next(csv.reader(f))
+    keycol = header.index(key)
+    size = os.path.getsize(fname)
+    bounds = find_boundaries(fname,max(1,size//workers))
+    tasks = [(fname,keycol,nshards,a,b,n,max_open)
+             for n,(a,b) in enumerate(zip(bounds[:-1],bounds[1:]))]
+    written = _pool_map(_partition_range,tasks,workers)
+
+    fname_nocsv = fname.split(".")[0]
+    keys = {}
+    for shards in written:
+        for shard,values in shards.items():
+            keys.setdefault(shard,set()).update(values)
+    clashes = [sorted(x) for x in keys.values() if len(x) > 1]
+    if clashes:
+        for part,shards in enumerate(written):
+            for shard in shards:
+                os.remove(fname_nocsv+"_"+shard+".part"+str(part))
+        raise ValueError(f"Keys {clashes[0]} map to the same file name")
+
+    for shard in sorted(keys):
+        writechunk([],shard,fname,header)
+        with open(fname_nocsv+"_"+shard+".csv",'ab') as out:
+            for part,shards in enumerate(written):
+                if shard in shards:
+                    partname = fname_nocsv+"_"+shard+".part"+str(part)
+                    with open(partname,'rb') as f:
+                        shutil.copyfileobj(f,out,1 << 22)
+                    os.remove(partname)
+    return sorted(keys)
+
+
+if __name__ == "__main__":
+    fname = " " # name of the file to be split
+    fdir = " " # the full path of the file to be split
+    csvlen = 200000 # the length of the resultant file(s), in rows
+    mode = "rows" # "rows", "bytes" or "key"
+    nbytes = 100*(1 << 20) # the size of the resultant file(s) in "bytes" mode
+    key = "student" # the column to split on in "key" mode
+    workers = 1 # the number of processes to split with in "bytes" and "key" mode
+    os.chdir(fdir)
+    with open(fname,'r',newline="") as f:
+        header = next(csv.reader(f))
+
+    if mode == "rows":
+        split_rows(fname,csvlen)
+    elif mode == "bytes":
+        split_bytes(fname,nbytes,workers)
+    else:
+        split_key(fname,key,workers=workers)
 
 
 
@@ -0,0 +1 @@
+from .logsim import logsim, logsim_chunks, logsim_arrays, logsim_csv
@@ -0,0 +1,189 @@
+def logsim(nstud,notp,skills,noise=None):
+    """
+    Returns a list of lists of simulated student data.
+
+    nstud:  int, the number of students per skill to simulate
+    notp:   int, the number of problems to simulate per student per skill
+    skills: dict, skill names as keys and bkt parameters as list for values
+            e.g. {'skill1': [l0,g,s,t],'skill2': [l0,g,s,t]}
+    noise:  float, default None. Used to add noise to correctness predictions.
+            loggen_bkt predicts student correctness, and compares that value
+            to a flat random distribution between 0 and 1. If noise is set to
+            a float, it is passed as the standard deviation to a gaussian
+            centered to zero, and added to the result of the flat random.
+            noise = -1 is true random data.
+    """
+    import random
+
+    class _skill:
+        def __init__(self,s):
+            self.l0 = s[0]
+            self.g = s[1]
+            self.s = s[2]
+            self.t = s[3]
+            return
+
+    def _ln(skill,ln,correct):
+        mns = ln*(1-skill.s)
+        ms = ln*skill.s
+        nmg = (1-ln)*skill.g
+        nc = 1-correct
+        nmng = (1-ln)*(1-skill.g)
+
+        ca = float(mns)/float((mns+nmg))
+        ica = float(ms)/float((ms+nmng))
+        new = ((correct*ca) + (nc*ica))
+
+        return new + ((1-new)*skill.t)
+
+    i = 1
+
+    r = [["index","studentid","skillid","correct"]]
+    for _s in skills.keys():
+        skill = _skill(skills[_s])
+        for j in range(nstud):
+            ln = skill.l0
+            for _ in range(notp):
+                out = [i,j,_s]
+                pcorr = (ln * (1 - skill.s)) + ((1 - ln) * skill.g)
+
+                if noise == -1:
+                    pcorr = random.choice([0,1])
+                    ln = _ln(skill,ln,pcorr)
+                    out.append(pcorr)
+                    r.append(out)
+                    i += 1
+                    continue
+
+                if noise:
+                    c = random.random() + random.gauss(0,noise)
+                    if c < 0: c = 0
+                    if c > 1: c = 1
+
+                else:
+                    c = random.random()
+
+                ln = _ln(skill,ln,1) if pcorr > c else _ln(skill,ln,0)
+                out.append(1 if pcorr > c else 0)
+                r.append(out)
+                i += 1
+    return r
+
+def logsim_chunks(nstud,notp,skills,noise=None,seed=None,chunk_rows=1000000):
+    """
+    Vectorized version of logsim, for generating very large datasets. Every
+    student of a skill is stepped through their problems together with NumPy,
+    and the data is yielded in chunks of about chunk_rows rows, so memory use
+    doesn't grow with the size of the dataset. Rows come out in the same order
+    as logsim, with the same noise semantics.
+
+    nstud, notp, skills, noise: as in logsim
+    seed:       int or None, seeds the numpy random Generator. Each skill draws
+                from its own stream, so the data for a given seed doesn't
+                depend on chunk_rows.
+    chunk_rows: int, the largest number of rows to yield at a time (rounded up
+                to a whole student)
+
+    Yields (index, studentid, skillid, correct) for each chunk, where index,
+    studentid and correct are numpy arrays and skillid is the skill name that
+    every row of the chunk belongs to.
+    """
+    import numpy as np
+
+    streams = np.random.SeedSequence(seed).spawn(len(skills))
+    cstud = max(1,chunk_rows//max(notp,1))
+    i = 1
+
+    for _s,ss in zip(skills.keys(),streams):
+        l0,g,s,t = skills[_s]
+        uniform,gauss = [np.random.default_rng(x) for x in ss.spawn(2)]
+        opp = np.arange(notp)
+        for start in range(0,nstud,cstud):
+            n = min(cstud,nstud-start)
+            c = uniform.random((n,notp))
+
+            if noise == -1:
+                correct = (c < 0.5).astype(np.int8)
+            else:
+                if noise:
+                    c += gauss.normal(0,noise,(n,notp))
+                    np.clip(c,0,1,out=c)
+                correct = np.empty((n,notp),dtype=np.int8)
+                ln = np.full(n,float(l0))
+                with np.errstate(divide='ignore',invalid='ignore'):
+                    for o in opp:
+                        pcorr = (ln*(1-s)) + ((1-ln)*g)
+                        corr = pcorr > c[:,o]
+                        correct[:,o] = corr
+                        new = np.where(corr,(ln*(1-s))/pcorr,(ln*s)/(1-pcorr))
+                        ln = new + ((1-new)*t)
+
+            index = np.arange(i,i+(n*notp),dtype=np.int64)
+            studentid = np.repeat(np.arange(start,start+n,dtype=np.int64),notp)
+            yield index,studentid,_s,correct.ravel()
+            i += n*notp
+
+def logsim_arrays(nstud,notp,skills,noise=None,seed=None,chunk_rows=1000000):
+    """
+    Runs logsim_chunks and returns the whole dataset as a dict of numpy arrays,
+    keyed by the column names logsim uses.
+    """
+    import numpy as np
+
+    cols = {"index": [],"studentid": [],"skillid": [],"correct": []}
+    for index,studentid,skillid,correct in logsim_chunks(nstud,notp,skills,noise,seed,chunk_rows):
+        cols["index"].append(index)
+        cols["studentid"].append(studentid)
+        cols["skillid"].append(np.full(len(index),skillid,dtype=object))
+        cols["correct"].append(correct)
+    return {k: np.concatenate(v) if v else np.empty(0) for k,v in cols.items()}
+
+def logsim_csv(fname,nstud,notp,skills,noise=None,seed=None,chunk_rows=1000000):
+    """
+    Runs logsim_chunks and streams the dataset to fname as a .csv with the same
+    columns as logsim. Returns the number of rows written.
+    """
+    import csv
+    from itertools import repeat
+
+    n = 0
+    with open(fname,'w',newline="",buffering=1 << 22) as f:
+        writer = csv.writer(f)
+        writer.writerow(["index","studentid","skillid","correct"])
+        for index,studentid,skillid,correct in logsim_chunks(nstud,notp,skills,noise,seed,chunk_rows):
+            writer.writerows(zip(index.tolist(),studentid.tolist(),repeat(skillid),correct.tolist()))
+            n += len(index)
+    return n
+
+if __name__ == "__main__":
+    import csv
+    import os
+
+    fdir = "your output directory"
+    fname = "your output filename"
+
+    nstud = 15
+    notp = 5
+    skills = {'skill1':[0.15,0.1,0.1,0.05],
+              'skill2':[0.35,0.15,0.05,0.15]}
+    noise = 0.5
+    vectorized = False # set to True to stream large datasets with logsim_csv
+    seed = None
+
+    os.chdir(fdir)
+    if vectorized:
+        logsim_csv(fname+".csv",nstud,notp,skills,noise,seed)
+    else:
+        res = logsim(nstud,notp,skills,noise)
+        with open(fname+".csv",'w',newline="") as f:
+            writer = csv.writer(f)
+            writer.writerows(res)
+
+
+'''
+Created on Jan 28, 2017
+v1.0 released Sep 22, 2017
+Correspondence and bugs should be directed to slater.research@gmail.com
+
+Licensed under the MIT License (MIT) - copyright 2017
+'''
@@ -1,3 +1,279 @@
+def _pack_lanes(corr,bounds):
+    '''
+    Packs a skill's responses into a padded, time-major array with one lane
+    (column) per student. corr holds the skill's responses in data order and
+    bounds holds the row offsets at which each student's run starts, plus the
+    total row count at the end.
+    
+    Lanes are ordered longest-first, so the students still practicing at
+    opportunity j are always the first nactive[j] lanes. Returns
+    (resp, nactive).
+    '''
+    import numpy as np
+    
+    bounds = np.asarray(bounds,dtype=np.int64)
+    lengths = np.diff(bounds)
+    nruns = len(lengths)
+    order = np.argsort(-lengths,kind="stable")
+    lane = np.empty(nruns,dtype=np.int64)
+    lane[order] = np.arange(nruns)
+    # lane[r] is the lane number assigned to run r
+    
+    run = np.repeat(np.arange(nruns),lengths)
+    pos = np.arange(bounds[-1]) - np.repeat(bounds[:-1],lengths)
+    resp = np.zeros((lengths.max(),nruns),dtype=np.int8)
+    resp[pos,lane[run]] = corr
+    
+    counts = np.bincount(lengths,minlength=lengths.max()+1)
+    nactive = nruns - np.cumsum(counts)[:-1]
+    return resp,nactive
+
+def _grid_sse(grid,lanes):
+    '''
+    Scores a block of parameter sets against one skill's lanes at once. grid
+    is a (sets x 4) array of [lzero,g,s,t] rows; p(Ln) is held as a
+    (sets x lanes) array. Returns the SSE of each parameter set.
+    '''
+    import numpy as np
+    
+    resp,nactive = lanes
+    l0,g,s,t = [x[:,None] for x in np.asarray(grid,dtype=float).T]
+    ln = np.repeat(l0,resp.shape[1],axis=1)
+    error = np.zeros(len(grid))
+    
+    for j in range(resp.shape[0]):
+        n = nactive[j]
+        lprev = ln[:,:n]
+        corr = resp[j,:n]
+        pcorr = (lprev*(1-s)) + ((1-lprev)*g)
+        error += np.sum((pcorr-corr)**2,axis=1)
+        
+        ca = (lprev*(1-s))/pcorr   # contribution of a correct answer
+        ica = (lprev*s)/(1-pcorr)  # contribution of an incorrect answer
+        new = (corr*ca) + ((1-corr)*ica)
+        ln[:,:n] = new + ((1-new)*t)
+    return error
+
+def _grid_block(task):
+    '''
+    Scores one contiguous block of a skill's parameter grid. task is (skill,
+    [lzero,g,s,t axes], first index, last index) into the flattened product
+    of the axes. Returns the block's best model as [[lzero,g,s,t],SSR].
+    '''
+    import numpy as np
+    
+    sk,axes,start,stop = task
+    idx = np.unravel_index(np.arange(start,stop),[len(x) for x in axes])
+    grid = np.column_stack([x[i] for x,i in zip(axes,idx)])
+    error = _grid_sse(grid,_opt_lanes[sk])
+    best = int(np.argmin(error))
+    return [[float(x) for x in grid[best]],float(error[best])]
+
+def _batch_sse_grad(params,lanes):
+    '''
+    _batch_sse with its analytic gradient. Carries the derivative of p(Ln)
+    with respect to (lzero,g,s,t) forward alongside the p(Ln) recursion, so
+    the SSE and its gradient come out of a single pass over the lanes.
+    Returns (SSE, gradient).
+    '''
+    import numpy as np
+    
+    resp,nactive = lanes
+    l0,g,s,t = [float(x) for x in params]
+    ln = np.full(resp.shape[1],l0)
+    dln = np.zeros((4,resp.shape[1]))
+    dln[0] = 1.0 # p(L0) is lzero, so only its own derivative is nonzero
+    error = 0.0
+    grad = np.zeros(4)
+    
+    for j in range(resp.shape[0]):
+        n = nactive[j]
+        lprev = ln[:n]
+        dprev = dln[:,:n]
+        corr = resp[j,:n]
+        
+        pcorr = (lprev*(1-s)) + ((1-lprev)*g)
+        dpcorr = dprev*(1-s-g)
+        dpcorr[1] += 1-lprev
+        dpcorr[2] -= lprev
+        
+        diff = pcorr-corr
+        error += np.dot(diff,diff)
+        grad += 2*np.dot(dpcorr,diff)
+        
+        pinc = 1-pcorr
+        ca = (lprev*(1-s))/pcorr   # contribution of a correct answer
+        ica = (lprev*s)/pinc       # contribution of an incorrect answer
+        dca = (dprev*(1-s) - ca*dpcorr)/pcorr
+        dca[2] -= lprev/pcorr
+        dica = (dprev*s + ica*dpcorr)/pinc
+        dica[2] += lprev/pinc
+        
+        new = (corr*ca) + ((1-corr)*ica)
+        dnew = (corr*dca) + ((1-corr)*dica)
+        ln[:n] = new + ((1-new)*t)
+        dln[:,:n] = dnew*(1-t)
+        dln[3,:n] += 1-new
+    return float(error),grad
+
+def _batch_em(lanes,params,b,tol=1e-6,maxiter=100):
+    '''
+    Fits BKT to one skill's lanes with Baum-Welch on the two-state
+    (unlearned, learned) HMM. Scaled forward and backward passes run across
+    all student lanes at once. Iterates until the relative change in
+    log-likelihood falls below tol or maxiter passes have run, clipping each
+    M-step into the bounds b. Returns ([lzero,g,s,t], log-likelihood of the
+    last E-step).
+    '''
+    import numpy as np
+    
+    resp,nactive = lanes
+    nsteps,nlanes = resp.shape
+    lo = np.array([x[0] for x in b])
+    hi = np.array([x[1] for x in b])
+    l0,g,s,t = np.clip(np.asarray(params,dtype=float),lo,hi)
+    tiny = np.finfo(float).tiny
+    
+    # forward quantities are stored ragged, one entry per response: the
+    # responses at opportunity j are entries off[j]:off[j+1], in lane order,
+    # so memory follows the row count rather than longest run x students
+    off = np.concatenate(([0],np.cumsum(nactive)))
+    a0 = np.empty(off[-1]) # scaled p(unlearned | responses so far)
+    a1 = np.empty(off[-1]) # scaled p(learned | responses so far)
+    scale = np.empty(off[-1])
+    prevll = None
+    
+    for _ in range(maxiter):
+        p0 = np.full(nlanes,1-l0)
+        p1 = np.full(nlanes,l0)
+        for j in range(nsteps):
+            n = nactive[j]
+            r = slice(off[j],off[j+1])
+            corr = resp[j,:n]
+            # emission probabilities of each observed response, per state
+            f0 = p0[:n]*np.where(corr == 1,g,1-g)
+            f1 = p1[:n]*np.where(corr == 1,1-s,s)
+            c = f0+f1
+            scale[r] = c
+            a0[r] = f0/c
+            a1[r] = f1/c
+            p0[:n] = a0[r]*(1-t)
+            p1[:n] = a1[r] + (a0[r]*t)
+        ll = float(np.sum(np.log(scale)))
+        
+        b0 = np.ones(nlanes)
+        b1 = np.ones(nlanes)
+        n0 = np.zeros(nlanes)   # expected unlearned steps with a successor
+        ntrans = 0.0
+        r = slice(off[-2],off[-1])
+        corr = resp[-1,:nactive[-1]]
+        num_g = np.sum(a0[r]*corr)
+        den_g = np.sum(a0[r])
+        num_s = np.sum(a1[r]*(1-corr))
+        den_s = np.sum(a1[r])
+        for j in range(nsteps-2,-1,-1):
+            n = nactive[j]
+            m = nactive[j+1]
+            r = slice(off[j],off[j+1])
+            rm = slice(off[j],off[j]+m)
+            nxt = slice(off[j+1],off[j+2])
+            corr = resp[j+1,:m]
+            w0 = np.where(corr == 1,g,1-g)*b0[:m]/scale[nxt]
+            w1 = np.where(corr == 1,1-s,s)*b1[:m]/scale[nxt]
+            ntrans += np.sum(a0[rm]*t*w1)
+            n0[:m] += a0[rm]*(((1-t)*w0) + (t*w1))
+            b0[:m] = ((1-t)*w0) + (t*w1)
+            b1[:m] = w1
+            b0[m:n] = 1.0
+            b1[m:n] = 1.0
+            
+            g0 = a0[r]*b0[:n]
+            g1 = a1[r]*b1[:n]
+            corr = resp[j,:n]
+            num_g += np.sum(g0*corr)
+            den_g += np.sum(g0)
+            num_s += np.sum(g1*(1-corr))
+            den_s += np.sum(g1)
+        
+        new = np.array([np.mean(a1[:off[1]]*b1),
+                        num_g/max(den_g,tiny),
+                        num_s/max(den_s,tiny),
+                        ntrans/max(np.sum(n0),tiny)])
+        l0,g,s,t = np.clip(new,lo,hi)
+        
+        if prevll is not None and abs(ll-prevll) <= tol*abs(prevll):
+            break
+        prevll = ll
+    return [float(l0),float(g),float(s),float(t)],ll
+
+_opt_lanes = {}
+
+def _init_opt_worker(lanes):
+    '''
+    Process pool initializer for kt.opt and kt.bf. Stores every skill's lanes
+    in the worker once, so tasks only need to ship the skill ID and the
+    parameters to try.
+    '''
+    _opt_lanes.clear()
+    _opt_lanes.update(lanes)
+
+def _opt_restart(task):
+    '''
+    Runs a single L-BFGS-B restart for one skill. task is (skill, starting
+    parameters, bounds). Returns [[lzero,g,s,t],SSR].
+    '''
+    from scipy.optimize import minimize
+    
+    sk,start,b = task
+    mdl = minimize(_batch_sse_grad,start,args=(_opt_lanes[sk],),
+                   method="L-BFGS-B",jac=True,bounds=b)
+    return [[float(x) for x in mdl['x']],float(mdl['fun'])]
+
+def _batch_sse(params,lanes):
+    '''
+    Vectorized equivalent of kt.fit. Advances p(Ln) for every student lane of
+    a skill together, one opportunity at a time, and returns the summed
+    squared error of the p(corr) predictions.
+    '''
+    import numpy as np
+    
+    resp,nactive = lanes
+    l0,g,s,t = [float(x) for x in params]
+    ln = np.full(resp.shape[1],l0)
+    error = 0.0
+    
+    for j in range(resp.shape[0]):
+        n = nactive[j]
+        lprev = ln[:n]
+        corr = resp[j,:n]
+        pcorr = (lprev*(1-s)) + ((1-lprev)*g)
+        diff = pcorr-corr
+        error += np.dot(diff,diff)
+        
+        ca = (lprev*(1-s))/pcorr   # contribution of a correct answer
+        ica = (lprev*s)/(1-pcorr)  # contribution of an incorrect answer
+        new = (corr*ca) + ((1-corr)*ica)
+        ln[:n] = new + ((1-new)*t)
+    return float(error)
+
+def _ln_step(lprev,g,s,t,corr):
+    '''
+    A single BKT knowledge update, shared by kt.ln_update, ktonline and
+    apply_params_stream so they all do exactly the same arithmetic. Returns
+    the updated p(ln), and the contributions of a correct and an incorrect
+    answer to it before learning.
+    '''
+    mns = lprev*(1-s)      # in mastery state, no slip
+    ms = lprev*s           # in mastery state, slip
+    nmg = (1-lprev)*g      # in no mastery state, correct guess
+    nmng = (1-lprev)*(1-g) # in no mastery state, incorrect guess
+    nc = 1-corr            # not correct
+    
+    ca = float(mns)/float((mns+nmg)) # contribution of a correct answer
+    ica = float(ms)/float((ms+nmng)) # contribution of incorrect answer
+    new = ((corr*ca) + (nc*ica))     # intermediate p(ln)
+    return new + ((1-new)*t),ca,ica  # the updated p(ln) given answer and p(t)
+
 class kt(object):
     
     '''
@@ -13,6 +289,8 @@ class kt(object):
     optimization is guaranteed to produce the best fit to the data, it takes 
     an impressively long amount of time to run on any single machine (on the
     order of multiple days for students counts in the tens of thousands).
+    Blocks of the grid are scored as arrays, optionally across processes, and
+    a coarse grid can be refined around its best model to keep this down.
     
     bkt.opt is a gradient descent implementation of the bkt model using the 
     function minimization library from SCiPy. Rather than using an exhaustive 
@@ -22,10 +300,23 @@ class kt(object):
     reduction of accuracy associated with BF vs. OPT can be found in 
     <forthcoming paper>.
     
+    bkt.em fits the same model with Expectation-Maximization (Baum-Welch) on
+    the two-state hidden Markov model. It needs a single start per skill and
+    usually converges within a handful of passes over the data.
+    
     bkt.fit is the optimization algorithm used to measure model performance, 
     but can also be used to describe the fit of any given set of parameters, or
     to apply calculated p(ln) and p(corr) calculations to a set of data.
     
+    bkt.fit_batch computes the same error as bkt.fit, but advances every 
+    student of a skill together using NumPy arrays built by bkt.lanes. This 
+    is what opt uses internally.
+    
+    On construction the student, skill and correct columns are also stored
+    as compact integer arrays in bkt.cols, grouped by skill. The fitters read
+    these rather than the rows; pass keep_rows=False to drop the rows when
+    only fitting is needed.
+    
     Some basic naming principles: _n class attributes are line-by-line
     parameters. They should not be global variables anywhere where this
     matters,so be careful if you decide to use them in some extension somewhere.
@@ -33,9 +324,10 @@ class kt(object):
     implemented yet.
     '''
     def __init__(self,data,student="student",skill="skill",
-                 order="order",correct="correct",debug=False):
+                 order="order",correct="correct",debug=False,keep_rows=True):
         
         from operator import itemgetter
+        import numpy as np
         self.data = data 
         self.header = [x.lower() for x in self.data[0]]
         del self.data[0]
@@ -53,6 +345,34 @@ class kt(object):
         self.data.sort(key=itemgetter(self.student,self.skill,self.order))
         # sorting the data by ordering variable, then by skill, then by student
         
+        skillcodes = dict((x,n) for n,x in enumerate(self.skillids))
+        studentcodes = {}
+        for x in self.data:
+            studentcodes.setdefault(x[self.student],len(studentcodes))
+        self.studentids = list(studentcodes)
+        
+        nrows = len(self.data)
+        skill_c = np.fromiter((skillcodes[x[self.skill]] for x in self.data),
+                              dtype=np.int32,count=nrows)
+        grouped = np.argsort(skill_c,kind="stable")
+        self.cols = {
+            'student': np.fromiter((studentcodes[x[self.student]] 
+                                    for x in self.data),
+                                   dtype=np.int32,count=nrows)[grouped],
+            'skill': skill_c[grouped],
+            'correct': np.fromiter((int(x[self.correct]) for x in self.data),
+                                   dtype=np.int8,count=nrows)[grouped]}
+        counts = np.bincount(skill_c,minlength=len(self.skillids))
+        offsets = np.cumsum(counts) - counts
+        self.skill_slices = dict((x,(int(offsets[n]),int(counts[n])))
+                                 for n,x in enumerate(self.skillids))
+        # columnar copy of the data, integer-coded and grouped by skill, with
+        # each skill's rows in (student, order) order at skill_slices[skill]
+        
+        if not keep_rows:
+            self.data = None
+        # the fitters only need the columns; apply_params and fit need rows
+        
         self.ln_n = None
         self.lprev_n = None
         self.corr_n = None
@@ -113,15 +433,7 @@ class kt(object):
         s = self.params_n[2]
         t = self.params_n[3]
         
-        mns = self.lprev_n*(1-s)      # in mastery state, no slip
-        ms = self.lprev_n*s           # in mastery state, slip
-        nmg = (1-self.lprev_n)*g      # in no mastery state, correct guess
-        nmng = (1-self.lprev_n)*(1-g) # in no mastery state, incorrect guess
-        nc = 1-self.corr_n            # not correct
-        
-        ca = float(mns)/float((mns+nmg)) # contribution of a correct answer
-        ica = float(ms)/float((ms+nmng)) # contribution of incorrect answer
-        new = ((self.corr_n*ca) + (nc*ica))  # intermediate p(ln)
+        ln,ca,ica = _ln_step(self.lprev_n,g,s,t,self.corr_n)
         
         if self.debug:
             self.corr_n_fc = 1
@@ -129,11 +441,11 @@ class kt(object):
             self.corr_n_fi = 0
             newfi = ((self.corr_n_fi*ca) + ((1-self.corr_n_fi)*ica))
             
-            return [new + ((1-new)*t),
+            return [ln,
                     newfc + ((1-newfc)*t),
                     newfi + ((1-newfi)*t)]
         
-        return new + ((1-new)*t) # the updated p(ln) given answer and p(t)
+        return ln
                 
     def fit(self,params,subset):
         '''
@@ -156,55 +468,129 @@ class kt(object):
             self.lprev_n = self.ln_n
         return error
     
-    def bf(self,gmax=50,smax=50):
+    def lanes(self,subset):
+        '''
+        Packs a single skill's subset into the padded lane array used by
+        fit_batch. Build it once per skill and reuse it across parameter sets.
+        '''
+        import numpy as np
+        
+        corr = np.array([int(l[self.correct]) for l in subset],dtype=np.int8)
+        bounds = [0]
+        for n in range(1,len(subset)):
+            if subset[n][self.student] != subset[n-1][self.student]:
+                bounds.append(n)
+        bounds.append(len(subset))
+        return _pack_lanes(corr,bounds)
+    
+    def skill_lanes(self,sk):
+        '''
+        Builds the lanes for one skill straight from the columnar store,
+        without touching the row data.
+        '''
+        import numpy as np
+        
+        offset,length = self.skill_slices[sk]
+        stud = self.cols['student'][offset:offset+length]
+        corr = self.cols['correct'][offset:offset+length]
+        bounds = np.concatenate(([0],np.flatnonzero(stud[1:] != stud[:-1])+1,
+                                 [length]))
+        return _pack_lanes(corr,bounds)
+    
+    def fit_batch(self,params,lanes):
+        '''
+        Vectorized variant of fit. Takes the output of lanes() rather than a
+        list of rows, and returns the same sum of squared error.
+        '''
+        return _batch_sse(params,lanes)
+    
+    def fit_grad(self,params,lanes):
+        '''
+        Like fit_batch, but also returns the analytic gradient of the error
+        with respect to [lzero,g,s,t]. opt passes this to the optimizer as
+        its jacobian instead of estimating it with finite differences.
+        '''
+        return _batch_sse_grad(params,lanes)
+    
+    def bf(self,gmax=50,smax=50,step=0.01,refine=0,maxmem=2**28,n_jobs=1):
         '''
         Brute force implementation of Bayesian Knowledge Tracing. Exhaustively
-        fits the model space to find the best model, to within 0.01.
-        Prohibitively slow. Here for completeness, not for any practical use.
+        fits the model space to find the best model, to within step (0.01 by
+        default). Every parameter set in a block of the grid is scored against
+        the skill's responses at once, so this is practical for skills with
+        few responses, but still grows with the size of the grid.
+        Produces dict[skill_id]: [[lzero,g,s,t],SSR], the same as opt.
+        
+        gmax, smax: upper bounds for guess and slip, in hundredths
+        step:       grid spacing for the first pass
+        refine:     number of coarse-to-fine passes after the first. Each pass
+                    searches a grid ten times finer, spanning one step of the
+                    previous grid either side of its best model.
+        maxmem:     approximate bytes of working memory per block of the grid
+        n_jobs:     number of worker processes to score grid blocks across
         '''
-        import itertools
+        import numpy as np
         
-        lzero_range = [x/100.0 for x in xrange(1,101)]
-        g_range = [x/100.0 for x in xrange(1,gmax+1)]
-        s_range = [x/100.0 for x in  xrange(1,smax+1)]
-        t_range = [x/100.0 for x in xrange(1,101)]
-        pspace = list(itertools.product(lzero_range,g_range,s_range,t_range))
+        b = [(step,1.0),(step,gmax/100.0),(step,smax/100.0),(step,1.0)]
         
-        bestmodels = {} # an index of the best model parameters per skill
+        lanes = {}
+        for sk in self.skillids:
+            lanes[sk] = self.skill_lanes(sk)
+        axes = dict((sk,[np.round(np.arange(lo,hi+step/2,step),10)
+                         for lo,hi in b]) for sk in self.skillids)
         
-        for x in self.skillids:
-            sksubset = [r for r in self.data if r[self.skill] == x]
-            best_model_i = None # for tracking the best-performing model
-            
-            for pset in pspace:
-                error = 0
-                
-                c_stud = sksubset[0][self.student] # the first student
-                prevln = pset[0] # initial knowledge
-                
-                for z in sksubset:
-                    if c_stud != z[self.student]: # same student or not?
-                        prevln = pset[0]
+        pool = None
+        if n_jobs > 1:
+            from concurrent.futures import ProcessPoolExecutor
+            pool = ProcessPoolExecutor(n_jobs,initializer=_init_opt_worker,
+                                       initargs=(lanes,))
+        else:
+            _init_opt_worker(lanes)
+        
+        bestmodels = {} # an index of the best model parameters per skill
+        try:
+            for level in range(refine+1):
+                tasks = []
+                for sk in self.skillids:
+                    size = int(np.prod([len(x) for x in axes[sk]]))
+                    # roughly eight (block x lanes) float arrays are live per step
+                    block = max(1,int(maxmem//(8*8*lanes[sk][0].shape[1])))
+                    tasks.extend((sk,axes[sk],i,min(i+block,size))
+                                 for i in range(0,size,block))
+                if pool:
+                    res = pool.map(_grid_block,tasks)
+                else:
+                    res = map(_grid_block,tasks)
                 
-                ln = self.ln_update(prevln,pset,z[self.correct])
-                error += self.calc_error(self.calc_pcorr(ln,pset),z[self.correct])**.5
+                bestmodels = {}
+                for (sk,_,_,_),mdl in zip(tasks,res):
+                    if sk not in bestmodels or mdl[1] < bestmodels[sk][1]:
+                        bestmodels[sk] = mdl
                 
-                if not best_model_i:
-                    best_model_i = list(pset).append(error)
-                elif error < best_model_i[-1]:
-                    best_model_i = list(pset).append(error)
-            bestmodels[x] = best_model_i
+                fine = step/(10.0**(level+1))
+                span = np.arange(-10,11)*fine
+                for sk in self.skillids:
+                    axes[sk] = [np.unique(np.clip(np.round(p+span,10),lo,hi))
+                                for p,(lo,hi) in zip(bestmodels[sk][0],b)]
+        finally:
+            if pool:
+                pool.shutdown()
         self.bestmodels = bestmodels
     
-    def opt(self,nstart,gmax=.50,smax=.50):
+    def opt(self,nstart,gmax=.50,smax=.50,n_jobs=1,seed=None):
         '''
         Function optimization variant of Bayesian Knowledge Tracing model
         fitting. Significantly improved performance over brute force fitting.
         Produces dict[skill_id]: [[lzero,g,s,t],SSR]
+        
+        n_jobs: number of worker processes to spread (skill, restart) fits
+                across. Every skill's lanes are sent to each worker once, when
+                the pool starts, rather than once per restart.
+        seed:   seeds the random starts. Fits with the same seed produce the
+                same bestmodels regardless of n_jobs.
         '''
         import random
         import sys
-        from scipy.optimize import minimize
         
         modelres = {}
         
@@ -212,37 +598,65 @@ class kt(object):
         
         def set_seeds(nstart,gmax,smax):
             pspace = {}
-            for _ in xrange(nstart):
-                seed = random.randint(0,sys.maxint)
-                random.seed(seed)
-                lzero = random.random()
-                g = random.uniform(0,0.5)
-                s = random.uniform(0,0.5)
-                t = random.random()
+            rng = random.Random(seed)
+            for _ in range(nstart):
+                pseed = rng.randint(0,sys.maxsize)
+                prng = random.Random(pseed)
+                lzero = prng.random()
+                g = prng.uniform(0,0.5)
+                s = prng.uniform(0,0.5)
+                t = prng.random()
                 if g == 0:
                     g = 0.01
                 if s == 0:
                     s = 0.01
-                pspace[seed] = [lzero,g,s,t]
+                pspace[pseed] = [lzero,g,s,t]
             return pspace
                 
         pspace = set_seeds(nstart,gmax,smax)
-        bestmod = ['model',sys.maxint]
-        methods = ["Nelder-Mead","Powell","CG","BFGS","Newton-CG",
-                   "L-BFGS-B","TNC","COBYLA","SLSQP","dogleg","trust-ncg"]
+        
+        lanes = {}
+        for sk in self.skillids:
+            lanes[sk] = self.skill_lanes(sk)
+        tasks = [(sk,pspace[p],b) for sk in self.skillids for p in pspace]
+        
+        if n_jobs > 1:
+            from concurrent.futures import ProcessPoolExecutor
+            
+            with ProcessPoolExecutor(n_jobs,initializer=_init_opt_worker,
+                                     initargs=(lanes,)) as pool:
+                chunk = max(1,len(tasks)//(n_jobs*4))
+                fits = list(pool.map(_opt_restart,tasks,chunksize=chunk))
+        else:
+            _init_opt_worker(lanes)
+            fits = [_opt_restart(x) for x in tasks]
+        
+        for (sk,_,_),mdl in zip(tasks,fits):
+            # restarts are visited in seed order, and only a strictly better
+            # fit replaces the incumbent, so ties resolve as they would serially
+            if sk not in modelres or mdl[1] < modelres[sk][1]:
+                modelres[sk] = mdl
+        self.bestmodels = modelres
+
+    def em(self,init=(0.3,0.2,0.1,0.1),gmax=.50,smax=.50,tol=1e-6,maxiter=100):
+        '''
+        Expectation-Maximization variant of Bayesian Knowledge Tracing model
+        fitting. Fits each skill with Baum-Welch on the two-state hidden 
+        Markov model, rather than random restarts on the squared error. 
+        Usually converges in a handful of passes over the data.
+        Produces dict[skill_id]: [[lzero,g,s,t],SSR], the same as opt.
+        
+        init:    starting parameters [lzero,g,s,t] for every skill
+        tol:     relative change in log-likelihood at which to stop
+        maxiter: maximum number of forward-backward passes per skill
+        '''
+        b = [(0.01,1),(0.01,gmax),(0.01,smax),(0.01,1)]
+        modelres = {}
         
         for sk in self.skillids:
-            subset = [i for i in self.data if i[self.skill] == sk]
-#             trueparams = [0.25,0.1,0.1,0.15]
-#             self.params_n = trueparams
-#             self.truefit = self.fit(trueparams,subset)
-            for p in pspace:
-                self.params_n = pspace[p]
-                mdl = minimize(self.fit,self.params_n,args=(subset,),
-                               method="L-BFGS-B",bounds = b)
-                if mdl['fun'] < bestmod[1]:
-                    bestmod = [map(float,mdl['x']),mdl['fun']]
-            modelres[sk] = bestmod
+            lanes = self.skill_lanes(sk)
+            params,_ = _batch_em(lanes,init,b,tol,maxiter)
+            modelres[sk] = [params,_batch_sse(params,lanes)]
         self.bestmodels = modelres
 
     def apply_params(self,fname,params=None):
@@ -253,10 +667,14 @@ class kt(object):
         as output, including the four model parameters, per skill, p(ln), and
         p(corr). Eventually I'll reconfigure this so that it produces an array
         as well, but that's not quite yet.
+        
+        This holds the whole dataset in memory. For files larger than that,
+        use apply_params_stream on a CSV already sorted by student, skill and
+        order.
         '''
             
         fname = fname.strip(".csv")
-        writer = csv.writer(open(fname+"_paramswritten.csv","wb"))
+        writer = csv.writer(open(fname+"_paramswritten.csv","w",newline=""))
         self.header.extend(['lzero','g','s','t','p(ln)','p(ln) forced correct',
                             'p(ln) forced incorrect','p(corr)']) ## take ln_fc and ln_fi out
         writer.writerow(self.header)
@@ -264,7 +682,7 @@ class kt(object):
         if params:
             self.params_n = params[self.data[0][self.skill]]
         else:
-            self.params_n = self.bestmodels[self.data[0][self.skill][0]]
+            self.params_n = self.bestmodels[self.data[0][self.skill]][0]
             
         self.lprev_n = self.params_n[0]
         st = self.data[0][self.student]
@@ -276,7 +694,7 @@ class kt(object):
                     self.params_n = params[d[self.skill]]
                 else:
                     self.params_n = self.bestmodels[d[self.skill]][0]
-            if st != d[self.student]:
+            if st != d[self.student] or sk != d[self.skill]:
                 self.lprev_n = self.params_n[0]
             self.corr_n = int(d[self.correct])
             self.debug = True ## remove this
@@ -293,6 +711,125 @@ class kt(object):
                 
         
 
+class ktonline(object):
+    
+    '''
+    Incremental scorer for live transaction streams. Built from fitted
+    parameters (a kt.bestmodels dict, or dict[skill]: [lzero,g,s,t]), it keeps
+    the current p(Ln) for every (student, skill) it has seen and updates it
+    one event at a time, using the same arithmetic as kt.ln_update.
+    
+    The state table can be written out with snapshot and read back with
+    restore, so a restarted worker can pick up where it left off without
+    replaying the stream.
+    '''
+    def __init__(self,params):
+        self.params = {}
+        for sk in params:
+            pset = params[sk]
+            if isinstance(pset[0],list):
+                pset = pset[0] # bestmodels format, [[lzero,g,s,t],SSR]
+            self.params[sk] = [float(x) for x in pset]
+        self.state = {} # (student, skill): current p(ln)
+    
+    def update(self,student,skill,correct):
+        '''
+        Scores a single event. Returns [p(ln), p(corr)]: the student's updated
+        knowledge of the skill, and the probability of a correct answer that
+        was predicted for this event before it was observed (the p(corr)
+        column of apply_params).
+        '''
+        lzero,g,s,t = self.params[skill]
+        lprev = self.state.get((student,skill),lzero)
+        ln = _ln_step(lprev,g,s,t,int(correct))[0]
+        
+        self.state[(student,skill)] = ln
+        return [ln,(lprev*(1-s)) + ((1-lprev)*g)]
+    
+    def update_batch(self,events):
+        '''
+        Scores a micro-batch of (student, skill, correct) events in order.
+        Returns a list of [p(ln), p(corr)], one per event.
+        '''
+        return [self.update(st,sk,c) for st,sk,c in events]
+    
+    def snapshot(self,fname):
+        '''
+        Writes the state table to fname as JSON. The file is written beside
+        fname first and then moved into place, so a crash mid-write never
+        leaves a partial snapshot behind.
+        '''
+        import json
+        import os
+        
+        tmp = fname+".tmp"
+        with open(tmp,'w') as f:
+            json.dump([[st,sk,ln] for (st,sk),ln in self.state.items()],f)
+        os.replace(tmp,fname)
+    
+    def restore(self,fname):
+        '''
+        Replaces the state table with one written by snapshot.
+        '''
+        import json
+        
+        with open(fname,'r') as f:
+            self.state = dict(((st,sk),ln) for st,sk,ln in json.load(f))
+
+def apply_params_stream(infile,outfile,params,student="student",skill="skill",
+                        correct="correct",batchsize=100000):
+    '''
+    Streaming equivalent of kt.apply_params. Reads infile, which must already
+    be sorted by student, skill and order, in batches of batchsize rows, and
+    writes the same columns apply_params does to outfile. Only the current
+    (student, skill) p(Ln) is carried between rows, so memory use does not
+    depend on the size of the file.
+    
+    params: dict[skill]: [lzero,g,s,t], or a fitted kt.bestmodels dict
+    '''
+    import csv
+    
+    with open(infile,'r',newline="") as fin, \
+         open(outfile,'w',newline="") as fout:
+        reader = csv.reader(fin)
+        writer = csv.writer(fout)
+        header = [x.lower() for x in next(reader)]
+        sti = header.index(student.lower())
+        ski = header.index(skill.lower())
+        ci = header.index(correct.lower())
+        writer.writerow(header + ['lzero','g','s','t','p(ln)',
+                                  'p(ln) forced correct',
+                                  'p(ln) forced incorrect','p(corr)'])
+        
+        key = None
+        pset = None
+        lprev = None
+        batch = []
+        for d in reader:
+            if key != (d[sti],d[ski]):
+                key = (d[sti],d[ski])
+                pset = params[d[ski]]
+                if isinstance(pset[0],list):
+                    pset = pset[0] # bestmodels format, [[lzero,g,s,t],SSR]
+                lprev = pset[0]
+            
+            g = pset[1]
+            s = pset[2]
+            t = pset[3]
+            ln,ca,ica = _ln_step(lprev,g,s,t,int(d[ci]))
+            
+            d.extend(pset)
+            d.extend([ln,ca + ((1-ca)*t),ica + ((1-ica)*t),
+                      (lprev*(1-s)) + ((1-lprev)*g)])
+            batch.append(d)
+            lprev = ln
+            
+            if len(batch) >= batchsize:
+                writer.writerows(batch)
+                batch = []
+        writer.writerows(batch)
+    return
+
 '''
 Created on Mar 29, 2017
 
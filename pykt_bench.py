@@ -0,0 +1,242 @@
+'''
+Benchmarks for the fitting code in pykt_attr_v5.py. Run directly to print
+timings; adjust the settings at the bottom of the file to change the size of
+the simulated skill.
+
+bench_suite times every fitter on logsim datasets with known parameters at
+several scales, measures how well each recovers those parameters, and writes
+the results to a .json file so runs from different versions can be compared.
+Its bf_vs_opt section is the BF vs OPT comparison referred to in the kt
+docstring; the same seed and settings reproduce it exactly.
+'''
+
+import random
+import time
+
+import pykt_attr_v5 as pykt
+
+
+def logsim_rows(nstud,notp,skills,noise=None,seed=0):
+    '''
+    Simulates a dataset with logsim, in the row format kt expects (header
+    first). logsim's running index is used as the order column.
+    '''
+    from logsim import logsim_chunks
+
+    rows = [["student","skill","order","correct"]]
+    for index,studentid,skillid,correct in logsim_chunks(nstud,notp,skills,noise,seed):
+        rows.extend([st,skillid,o,c] for o,st,c in
+                    zip(index.tolist(),studentid.tolist(),correct.tolist()))
+    return rows
+
+def bench_gradient(nstud=2000,notp=50,nstart=3,params=(0.3,0.2,0.1,0.15)):
+    '''
+    Compares L-BFGS-B fits of one skill using finite-difference gradients
+    (the original opt path) against the analytic jacobian from fit_grad.
+    Reports wall time, objective evaluations and the fitted SSE for each.
+    '''
+    from scipy.optimize import minimize
+
+    model = pykt.kt(logsim_rows(nstud,notp,{"skill1": list(params)}))
+    lanes = model.lanes(model.data)
+    b = [(0.01,1),(0.01,.5),(0.01,.5),(0.01,1)]
+    rng = random.Random(1)
+    starts = [[rng.random(),rng.uniform(0,.5),rng.uniform(0,.5),rng.random()]
+              for _ in range(nstart)]
+
+    print(f"{len(model.data)} rows, {lanes[0].shape[1]} students, {nstart} restarts")
+    for name,fn,jac in [("finite differences",pykt._batch_sse,None),
+                        ("analytic gradient",pykt._batch_sse_grad,True)]:
+        tic = time.perf_counter()
+        nfev = 0
+        best = None
+        for x0 in starts:
+            mdl = minimize(fn,x0,args=(lanes,),method="L-BFGS-B",jac=jac,bounds=b)
+            nfev += mdl['nfev']
+            if best is None or mdl['fun'] < best['fun']:
+                best = mdl
+        toc = time.perf_counter()
+        print(f"{name}: {toc-tic:.2f}s, {nfev} evaluations, SSE {best['fun']:.4f}, "
+              f"params {[round(float(x),3) for x in best['x']]}")
+
+def bench_online(nstud=2000,notp=50,params=(0.3,0.2,0.1,0.15)):
+    '''
+    Measures ktonline throughput in events per second, one event at a time
+    and in micro-batches, and checks that its p(Ln) matches kt.ln_update for
+    every event.
+    '''
+    model = pykt.kt(logsim_rows(nstud,notp,{"skill1": list(params)}))
+    events = [(r[model.student],r[model.skill],r[model.correct])
+              for r in model.data]
+    fitted = {"skill1": [list(params),None]}
+
+    scorer = pykt.ktonline(fitted)
+    tic = time.perf_counter()
+    scored = [scorer.update(*e) for e in events]
+    toc = time.perf_counter()
+    print(f"single events: {len(events)/(toc-tic):,.0f} events/sec")
+
+    scorer = pykt.ktonline(fitted)
+    tic = time.perf_counter()
+    for i in range(0,len(events),500):
+        scorer.update_batch(events[i:i+500])
+    toc = time.perf_counter()
+    print(f"batches of 500: {len(events)/(toc-tic):,.0f} events/sec")
+
+    model.params_n = list(params)
+    st = None
+    mismatches = 0
+    for r,(ln,_) in zip(model.data,scored):
+        if r[model.student] != st:
+            model.lprev_n = params[0]
+            st = r[model.student]
+        model.corr_n = int(r[model.correct])
+        model.lprev_n = model.ln_update()
+        mismatches += model.lprev_n != ln
+    print(f"{mismatches} of {len(events)} events differ from kt.ln_update")
+
+def true_params(nskills,seed=0):
+    '''
+    Draws ground-truth [l0,g,s,t] for nskills skills, within the ranges the
+    fitters search and away from their edges.
+    '''
+    rng = random.Random(seed)
+    return dict(("skill%d" % (n+1),[round(rng.uniform(0.1,0.6),2),
+                                     round(rng.uniform(0.05,0.3),2),
+                                     round(rng.uniform(0.05,0.3),2),
+                                     round(rng.uniform(0.05,0.3),2)])
+                for n in range(nskills))
+
+def recovery_error(bestmodels,truth):
+    '''
+    Mean absolute error of fitted parameters against the ground truth, per
+    parameter and overall, averaged across skills.
+    '''
+    names = ["l0","g","s","t"]
+    err = dict((x,0.0) for x in names)
+    for sk,params in truth.items():
+        for x,fitted,true in zip(names,bestmodels[sk][0],params):
+            err[x] += abs(float(fitted)-true)/len(truth)
+    err["mean"] = sum(err[x] for x in names)/len(names)
+    return err
+
+def measure(fn,*args,**kwargs):
+    '''
+    Runs fn, returning its result, the wall time in seconds and the peak
+    memory allocated while it ran, in bytes. Peak memory is traced with
+    tracemalloc, which slows Python-heavy code down somewhat; the overhead
+    is the same from run to run, so timings stay comparable.
+    '''
+    import tracemalloc
+
+    tracemalloc.start()
+    tic = time.perf_counter()
+    try:
+        res = fn(*args,**kwargs)
+        toc = time.perf_counter()
+        peak = tracemalloc.get_traced_memory()[1]
+    finally:
+        tracemalloc.stop()
+    return res,toc-tic,peak
+
+def bench_suite(scales=((200,10,2),(1000,20,4),(5000,50,4)),noise=None,seed=0,
+                nstart=5,bf_step=0.05,bf_refine=1,bf_maxrows=20000,
+                outfile="pykt_bench.json"):
+    '''
+    Times kt construction, fit, opt, bf, em and apply_params on logsim data at
+    each scale, and measures the parameters each fitter recovers against the
+    ground truth. Writes the results to outfile as .json and returns them.
+
+    scales:     (students, opportunities, skills) per dataset
+    noise:      passed to logsim
+    seed:       seeds the true parameters, the simulated data and opt's starts
+    nstart:     number of random starts for opt
+    bf_step, bf_refine: grid settings for bf
+    bf_maxrows: bf is skipped for datasets larger than this, as its time grows
+                with the size of the grid as well as the data
+    '''
+    import json
+    import os
+    import platform
+    import tempfile
+
+    import numpy as np
+    import scipy
+
+    results = {"settings": {"scales": [list(x) for x in scales],"noise": noise,
+                            "seed": seed,"nstart": nstart,"bf_step": bf_step,
+                            "bf_refine": bf_refine,"bf_maxrows": bf_maxrows},
+               "environment": {"python": platform.python_version(),
+                               "numpy": np.__version__,"scipy": scipy.__version__,
+                               "platform": platform.platform()},
+               "time": time.strftime("%Y-%m-%d %H:%M:%S"),
+               "runs": [],"bf_vs_opt": []}
+
+    for nstud,notp,nskills in scales:
+        truth = true_params(nskills,seed)
+        rows = logsim_rows(nstud,notp,truth,noise,seed)
+        nrows = len(rows)-1
+        run = {"students": nstud,"opportunities": notp,"skills": nskills,
+               "rows": nrows,"fitters": {}}
+        print(f"{nstud} students x {notp} opportunities x {nskills} skills, {nrows} rows")
+
+        def record(name,fn,*args,**kwargs):
+            res,wall,peak = measure(fn,*args,**kwargs)
+            run["fitters"][name] = {"seconds": wall,"rows_per_sec": nrows/wall,
+                                    "peak_bytes": peak}
+            print(f"  {name}: {wall:.2f}s, {nrows/wall:,.0f} rows/sec, "
+                  f"peak {peak/2**20:.1f} MB")
+            return res
+
+        model = record("load",pykt.kt,rows)
+
+        def fit_all():
+            return dict((sk,model.fit(truth[sk],[x for x in model.data
+                                                 if x[model.skill] == sk]))
+                        for sk in truth)
+        sse = record("fit",fit_all)
+        run["true_sse"] = sse
+
+        fitted = {}
+        for name,fn,kwargs in [("opt",model.opt,{"nstart": nstart,"seed": seed}),
+                               ("bf",model.bf,{"step": bf_step,"refine": bf_refine}),
+                               ("em",model.em,{})]:
+            if name == "bf" and nrows > bf_maxrows:
+                continue
+            record(name,fn,**kwargs)
+            fitted[name] = model.bestmodels
+            run["fitters"][name]["bestmodels"] = dict(
+                (sk,[[float(x) for x in p],float(e)]) for sk,(p,e) in model.bestmodels.items())
+            run["fitters"][name]["recovery_error"] = recovery_error(model.bestmodels,truth)
+            print(f"    mean absolute error {run['fitters'][name]['recovery_error']['mean']:.4f}")
+
+        with tempfile.TemporaryDirectory() as tmp:
+            record("apply_params",model.apply_params,os.path.join(tmp,"bench"),
+                   params=truth)
+        run["truth"] = truth
+        results["runs"].append(run)
+
+        if "bf" in fitted:
+            cmp = {"rows": nrows,"skills": {}}
+            for sk in truth:
+                bf,opt = fitted["bf"][sk],fitted["opt"][sk]
+                cmp["skills"][sk] = {"sse_diff": float(opt[1]-bf[1]),
+                                     "param_diff": [float(a-b) for a,b in zip(opt[0],bf[0])]}
+            cmp["speedup"] = (run["fitters"]["bf"]["seconds"]/
+                              run["fitters"]["opt"]["seconds"])
+            results["bf_vs_opt"].append(cmp)
+
+    with open(outfile,"w") as f:
+        json.dump(results,f,indent=2)
+    return results
+
+
+if __name__ == "__main__":
+    suite = False # set to True to run the full benchmark and recovery suite
+    outfile = "pykt_bench.json"
+
+    if suite:
+        bench_suite(outfile=outfile)
+    else:
+        bench_gradient()
+        bench_online()
@@ -0,0 +1,47 @@
+'''
+Benchmarks for the synchronization code in 20200910_Synch_V1.py. The script's name isn't a valid module name,
+so it is loaded from its path. Run directly to print timings.
+'''
+
+import importlib.util
+import os
+import random
+import time
+
+spec = importlib.util.spec_from_file_location("synch", os.path.join(os.path.dirname(os.path.abspath(__file__)),
+                                                                    "20200910_Synch_V1.py"))
+synch = importlib.util.module_from_spec(spec)
+spec.loader.exec_module(synch)
+
+
+def bench_time_convert(nrows=200000, nseconds=5000, dt_format="%Y.%m.%d.%H.%M.%S.%f"):
+    '''
+    Compares time_convert against fast_time_convert and time_column on QRF-style timestamps, where many rows
+    share the same second. Checks that all three produce identical timestamps.
+    '''
+    rng = random.Random(0)
+    base = time.mktime((2019, 2, 11, 9, 0, 0, 0, 0, -1))
+    stamps = [time.strftime("%Y.%m.%d.%H.%M.%S", time.localtime(base + rng.randrange(nseconds)))
+              + ".%03d" % rng.randrange(1000) for _ in range(nrows)]
+    data = [["timestamp"]] + [[x] for x in stamps]
+
+    tic = time.perf_counter()
+    old = [x[-1] for x in synch.time_convert([x[:] for x in data], 0, dt_format, 0)[1:]]
+    toc = time.perf_counter()
+    print(f"time_convert: {toc-tic:.2f}s")
+
+    synch.prefix_to_unix.cache_clear()
+    tic = time.perf_counter()
+    new = [x[-1] for x in synch.fast_time_convert([x[:] for x in data], 0, dt_format, 0, host_local=True)[1:]]
+    toc = time.perf_counter()
+    print(f"fast_time_convert: {toc-tic:.2f}s, identical: {old == new}")
+
+    synch.prefix_to_unix.cache_clear()
+    tic = time.perf_counter()
+    col = synch.time_column(stamps, dt_format, 0, host_local=True)
+    toc = time.perf_counter()
+    print(f"time_column: {toc-tic:.2f}s, identical: {old == col.tolist()}")
+
+
+if __name__ == "__main__":
+    bench_time_convert()